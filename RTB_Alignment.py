@@ -297,11 +297,7 @@ class MainWindow(qt.QWidget):
         
         curves = self._plotSpectraWindow.getAllCurves()
         motorvalue = []
-        peakposition = []
-        peakwidth = []
-        peakheight = []
-        
-        gaussian = lambda x, x0, amp, fwhm: amp* np.exp(-(x-x0)**2/2/(fwhm/2.35)**2)
+        xs, ys, p0 = [], [], []
         
         for i, curve in enumerate(curves):
             x, y, legend, info = curve
@@ -330,39 +326,41 @@ class MainWindow(qt.QWidget):
             
             if motorname in info['MotorNames']:
                 xval = info['MotorValues'][info['MotorNames'].index(motorname)]
-                peakpos, peak, myidx = self.specArithmetic.search_peak(x, y)
-                fwhm, cfwhm  = self.specArithmetic.search_fwhm(x, y, 
-                                                        peak=peak,index=myidx)
-                
-                # ~ popt, pcov = optimize.curve_fit(gaussian, x, y, p0=(peakpos, peak, fwhm))
-                popt, pcov = self.RTB_Math.curve_fit(
-                                    gaussian, x, y, p0=(peakpos, peak, fwhm))
-                motorvalue.append(xval)
-                peakposition.append(popt[0])
-                peakwidth.append(np.abs(popt[2]))
-                peakheight.append(popt[1])
-            
-            if motorname == 'S#':
+            elif motorname == 'S#':
                 xval = float(info['Key'])
-                peakpos, peak, myidx = self.specArithmetic.search_peak(x, y)
-                fwhm, cfwhm  = self.specArithmetic.search_fwhm(x, y, 
-                                                        peak=peak,index=myidx)
-                                                        
-                # ~ popt, pcov = optimize.curve_fit(gaussian, x, y, p0=(peakpos, peak, fwhm))
-                popt, pcov = self.RTB_Math.curve_fit(
-                                    gaussian, x, y, p0=(peakpos, peak, fwhm))
-                
-                motorvalue.append(xval)
-                peakposition.append(popt[0])
-                peakwidth.append(np.abs(popt[2]))
-                peakheight.append(popt[1])
-                
-        xy = np.array([motorvalue, peakposition, peakwidth, peakheight]).T
+            else:
+                continue
+            peakpos, peak, myidx = self.specArithmetic.search_peak(x, y)
+            fwhm, cfwhm  = self.specArithmetic.search_fwhm(x, y, 
+                                                    peak=peak,index=myidx)
+            motorvalue.append(xval)
+            xs.append(np.asarray(x, dtype=float))
+            ys.append(np.asarray(y, dtype=float))
+            p0.append((peakpos, peak, fwhm))
+        
+        # All curves are fitted at once, padded to the longest one
+        popt = np.zeros((0, 3))
+        perr = np.zeros((0, 3))
+        if xs:
+            x, y, mask = self.RTB_Math.pad_curves(xs, ys)
+            popt, pcov, fitinfo = self.RTB_Math.curve_fit_batch(x, y, 
+                'gaussian', p0=np.array(p0, dtype=float), mask=mask)
+            perr = fitinfo['perr']
+        peakposition = popt[:,0]
+        peakwidth = np.abs(popt[:,2])
+        peakheight = popt[:,1]
+        
+        # Uncertainties of the fitted position, height and width
+        xy = np.column_stack([motorvalue, peakposition, peakwidth, peakheight,
+            perr[:,0], perr[:,2], perr[:,1]])
         xy = 1. * xy[xy[:,0].argsort()]
         motorvalue = xy[:,0]
         peakposition = xy[:,1]
         peakwidth = xy[:,2]
         peakheight = xy[:,3]
+        peakposition_err = xy[:,4]
+        peakwidth_err = xy[:,5]
+        peakheight_err = xy[:,6]
         
         
         
@@ -372,7 +370,7 @@ class MainWindow(qt.QWidget):
         self._plotWidthWindow.clearCurves()
         self._plotWidthWindow.addCurve(motorvalue, peakwidth, legend='FWHM', 
             info={'xlabel': motorname, 'ylabel': 'FWHM'},
-            linestyle='none', symbol='o', color='k')
+            linestyle='none', symbol='o', color='k', yerror=peakwidth_err)
         self._plotWidthWindow.setGraphTitle('FWHM')
         #~ self._plotWidthWindow.removeMarker('x0')
         self.widthLabel.setText('')
@@ -400,7 +398,7 @@ class MainWindow(qt.QWidget):
         self._plotHeightWindow.clearCurves()
         self._plotHeightWindow.addCurve(motorvalue, peakheight, legend='Peak height', 
             info={'xlabel': motorname, 'ylabel': 'Peak height'},
-            linestyle='none', symbol='o', color='k')
+            linestyle='none', symbol='o', color='k', yerror=peakheight_err)
         self._plotHeightWindow.setGraphTitle('Peak height')
         #~ self._plotHeightWindow.removeMarker('x0')
         self.heightLabel.setText('')
@@ -428,7 +426,7 @@ class MainWindow(qt.QWidget):
         self._plotPosWindow.clearCurves()
         self._plotPosWindow.addCurve(motorvalue, peakposition, legend='Peak position', 
             info={'xlabel': motorname, 'ylabel': 'Peak position'},
-            linestyle='none', symbol='o', color='k')
+            linestyle='none', symbol='o', color='k', yerror=peakposition_err)
         self._plotPosWindow.setGraphTitle('Peak position')
         #~ self._plotPosWindow.removeMarker('x0')
         self.posLabel.setText('')
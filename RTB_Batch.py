@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+#/*##########################################################################
+# Copyright (C) 2016 K. Kummer, A. Tamborino, European Synchrotron Radiation
+# Facility
+#
+# This file is part of the ID32 RIXSToolBox developed at the ESRF by the ID32
+# staff and the ESRF Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+
+from __future__ import division
+
+__author__ = ["Kurt Kummer", "Annalisa Tamborrino"]
+__contact__ = "kurt.kummer@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+
+___doc__ = """
+    Convert CCD images into spectra without the graphical interface, e.g.
+
+    python RTB_Batch.py /data/Images -o /data/Spectra/sample.spec
+        --slope -0.0395 --workers 16
+"""
+
+
+import os
+import sys
+import time
+import json
+import glob
+import hashlib
+import argparse
+import tracemalloc
+import concurrent.futures
+
+import numpy as np
+
+from RixsSpectrum import RixsSpectrum, SpecFileWriter, HDF5FileWriter, \
+    hdf5_filename, aggregate_profiles, format_profile, SPEC_DIGITS
+import RTB_Dark
+
+
+
+def list_images(sources):
+    """
+    Images (*.edf, or *.nxs with their andor-*.hdf file) in the given
+    folders or matching the given file patterns, sorted by name
+    """
+    images = []
+    for source in sources:
+        if os.path.isdir(source):
+            listdir = os.listdir(source)
+            images += [os.path.join(source, s) for s in listdir
+                if s.endswith('.edf') or
+                (s.endswith('.nxs') and ''.join(['andor-',
+                    s.split('-')[1].replace('.nxs', '.hdf')]) in listdir)]
+        else:
+            images += [s for s in glob.glob(source)
+                if s.endswith('.edf') or s.endswith('.nxs')]
+    # Same image given twice is converted only once
+    return sorted(set(images), key=lambda s: (os.path.basename(s), s))
+
+
+def output_settings(digits=SPEC_DIGITS, savespecfile=True, 
+    savehdf5file=False, savedatfile=False, saveeventfile=False):
+    """ What a conversion writes, enters parameters_hash with outputs """
+    return dict(digits=digits, savespecfile=savespecfile, 
+        savehdf5file=savehdf5file, savedatfile=savedatfile, 
+        saveeventfile=saveeventfile)
+
+
+def output_files(outputfile, savespecfile=True, savehdf5file=False):
+    """ Files the spectra are appended to, see ImageManifest.add """
+    return ([outputfile] if savespecfile else []) + \
+        ([hdf5_filename(outputfile)] if savehdf5file else [])
+
+
+def parameters_hash(parameters, outputs=None):
+    """
+    Fingerprint of the reduction parameters and of the output settings 
+    (see output_settings). Arrays, i.e. the background image, enter with
+    their content. stream_frames does not change the spectra and is left
+    out.
+    """
+    items = dict(parameters)
+    items.update(('output.%s' % name, value) 
+        for name, value in (outputs or {}).items())
+    digest = hashlib.sha1()
+    for name in sorted(items):
+        if name == 'stream_frames':
+            continue
+        value = items[name]
+        if isinstance(value, np.ndarray):
+            value = (value.shape, str(value.dtype), hashlib.sha1(
+                np.ascontiguousarray(value)).hexdigest())
+        digest.update(('%s=%r;' % (name, value)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+
+class ImageManifest(object):
+    """
+    Record of the images already converted into a *.spec file, stored next
+    to it as <specfile>.manifest with one JSON entry per image and parameter
+    set: image path, size, modification time, parameters_hash, the scan
+    numbers written to the *.spec file and the device, inode and size of 
+    the output files after writing them
+    """
+    def __init__(self, specfilename):
+        self.filename = '%s.manifest' % specfilename
+        self.entries = {}
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line may be cut when the program was killed
+                        continue
+                    self.entries[(entry['image'], 
+                        entry.get('parameters'))] = entry
+    
+    
+    def is_converted(self, imgfilename, parameters):
+        """
+        True if the image was converted with the parameters (a 
+        parameters_hash) and neither the image nor the output files changed
+        since, i.e. the output files were not replaced or truncated
+        """
+        entry = self.entries.get((os.path.abspath(imgfilename), parameters))
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(imgfilename)
+            outputs = [(os.stat(fname), output) 
+                for fname, output in entry.get('outputs', {}).items()]
+        except OSError:
+            return False
+        return entry['size'] == stat.st_size and \
+            entry['mtime'] == stat.st_mtime and \
+            all([stat.st_dev, stat.st_ino] == output[:2] and 
+                stat.st_size >= output[2] for stat, output in outputs)
+    
+    
+    def add(self, imgfilename, parameters=None, scans=(), outputs=()):
+        """ outputs are the files the spectra were written to """
+        stat = os.stat(imgfilename)
+        entry = {'image': os.path.abspath(imgfilename), 
+            'size': stat.st_size, 'mtime': stat.st_mtime,
+            'parameters': parameters, 
+            'scans': [scan.split(None, 2)[1] for scan in scans],
+            'outputs': {}}
+        for fname in outputs:
+            output = os.stat(fname)
+            entry['outputs'][os.path.abspath(fname)] = [output.st_dev, 
+                output.st_ino, output.st_size]
+        self.entries[(entry['image'], parameters)] = entry
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        return None
+
+
+
+class FolderWatcher(object):
+    """
+    Polls a folder for new images. An image is only reported once its size
+    and modification time did not change for settle seconds, so that images
+    still being written are not read.
+    """
+    def __init__(self, folder, settle=2., ignore_existing=True):
+        self.folder = folder
+        self.settle = settle
+        self.reported = set()
+        if ignore_existing:
+            self.reported.update(list_images([folder]))
+        self.candidates = {}
+    
+    
+    def poll(self):
+        """ New images ready to be converted """
+        now = time.time()
+        ready = []
+        for imgfilename in list_images([self.folder]):
+            if imgfilename in self.reported:
+                continue
+            try:
+                stat = os.stat(imgfilename)
+            except OSError:
+                continue
+            key = (stat.st_size, stat.st_mtime)
+            if imgfilename not in self.candidates or \
+                self.candidates[imgfilename][0] != key:
+                self.candidates[imgfilename] = (key, now)
+            elif now - self.candidates[imgfilename][1] >= self.settle:
+                del self.candidates[imgfilename]
+                self.reported.add(imgfilename)
+                ready.append(imgfilename)
+        return ready
+
+
+
+# Parameters of the worker processes, set once by init_worker so that the
+# background image is not sent along with every image
+_worker = {}
+
+def init_worker(parameters, outputfile, savedatfile, saveeventfile,
+    digits=SPEC_DIGITS, savehdf5file=False, profile=False):
+    _worker['parameters'] = parameters
+    _worker['outputfile'] = outputfile
+    _worker['savedatfile'] = savedatfile
+    _worker['saveeventfile'] = saveeventfile
+    _worker['digits'] = digits
+    _worker['savehdf5file'] = savehdf5file
+    _worker['profile'] = profile
+    if profile and not tracemalloc.is_tracing():
+        # Peak memory of the reduction stages, see RixsSpectrum.profile
+        tracemalloc.start()
+
+
+def convert_image(imgfilename):
+    """
+    Reduce one image in a worker process. The *.dat and event files are
+    written here, the *.spec scans are returned to be written in order,
+    together with the pixel and photons columns of each frame, the HDF5
+    scans if saving the HDF5 file and the profile of the reduction stages.
+    """
+    x = RixsSpectrum(imgfilename, **_worker['parameters'])
+    scans = x.save(outputfile=_worker['outputfile'],
+        savedatfile=_worker['savedatfile'],
+        saveeventfile=_worker['saveeventfile'], savespecfile=False,
+        digits=_worker['digits'], saveprofile=_worker['profile'])
+    spectra = [(x.spectrum[framenumber]['Pixel'],
+                x.spectrum[framenumber]['Photons'])
+                for framenumber in range(len(x.spectrum))]
+    h5scans = x.make_hdf5_scans() if _worker['savehdf5file'] else []
+    return scans, spectra, h5scans, x.profile
+
+
+def batch_convert(images, outputfile, parameters, workers=None,
+    savedatfile=False, saveeventfile=False, skip_converted=True, 
+    digits=SPEC_DIGITS, savespecfile=True, savehdf5file=False, 
+    profile=False):
+    """
+    Convert the images on a pool of worker processes and append the spectra
+    to outputfile, and with savehdf5file to the *.h5 file next to it, in the
+    order of images. Images converted before into outputfile with the same 
+    parameters and output settings are skipped unless skip_converted is 
+    False or the output files were removed or truncated since. With profile, 
+    the time and peak memory of each reduction stage summed over all images
+    are printed. Returns the number of converted images.
+    """
+    folder = os.path.dirname(os.path.abspath(outputfile))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    phash = parameters_hash(parameters, output_settings(digits, 
+        savespecfile, savehdf5file, savedatfile, saveeventfile))
+    outputs = output_files(outputfile, savespecfile, savehdf5file)
+    manifest = ImageManifest(outputfile)
+    if skip_converted:
+        todo = [imgfilename for imgfilename in images 
+            if not manifest.is_converted(imgfilename, phash)]
+        if len(todo) < len(images):
+            print('Skipping %d images already converted' 
+                % (len(images) - len(todo)))
+        images = todo
+    if not images:
+        return 0
+    specwriter = SpecFileWriter(outputfile) if savespecfile else None
+    hdf5writer = HDF5FileWriter(hdf5_filename(outputfile)) \
+        if savehdf5file else None
+    profiles = []
+    write = {'time': 0., 'calls': 0, 'peak_memory': None}
+    t0 = time.perf_counter()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+            initializer=init_worker, initargs=(parameters, outputfile,
+                savedatfile, saveeventfile, digits, savehdf5file, profile)) \
+            as executor:
+            # map returns the results in the order of images
+            for imgfilename, (scans, spectra, h5scans, imgprofile) in zip(
+                images, executor.map(convert_image, images)):
+                t = time.perf_counter()
+                if specwriter is not None:
+                    specwriter.write(scans)
+                if hdf5writer is not None:
+                    hdf5writer.write(h5scans)
+                write['time'] += time.perf_counter() - t
+                write['calls'] += 1
+                manifest.add(imgfilename, phash, scans, outputs)
+                profiles.append(imgprofile)
+    finally:
+        for writer in [specwriter, hdf5writer]:
+            if writer is not None:
+                writer.close()
+    if profile:
+        total = aggregate_profiles(profiles)
+        total['write'] = write
+        print('Profile of %d images, %.2f s in total, stage times summed '
+            'over the workers:' % (len(images), time.perf_counter() - t0))
+        print('\n'.join(format_profile(total)))
+    return len(images)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert RIXS CCD images into spectra.')
+    parser.add_argument('sources', nargs='+',
+        help='image folders or file patterns, e.g. "Images/*_00[1-5]*.edf"')
+    parser.add_argument('-o', '--output', required=True,
+        help='output *.spec file, spectra are appended')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+        help='number of worker processes (default: number of cores)')
+    parser.add_argument('-f', '--force', action='store_true',
+        help='also convert images already converted with the same '
+            'parameters')
+
+    group = parser.add_argument_group('Parameters')
+    group.add_argument('--slope', type=float, default=-.0395)
+    group.add_argument('--points-per-pixel', type=float, default=2.7)
+    group.add_argument('--binning', type=int, default=1)
+    group.add_argument('--no-spc', dest='SPC', action='store_false',
+        help='no single photon counting')
+    group.add_argument('--stream-frames', action='store_true',
+        help='process NeXus stacks frame by frame to save memory')
+    group.add_argument('--float32', dest='precision', action='store_const',
+        const='float32', default='float64',
+        help='process the images in single precision to save memory, '
+            'spectra deviate by less than 1e-4 of their maximum')
+
+    group = parser.add_argument_group('Expert settings')
+    group.add_argument('--lower-threshold', type=float, default=-1e5)
+    group.add_argument('--upper-threshold', type=float, default=1e5)
+    group.add_argument('--masksize', type=int, default=5)
+    group.add_argument('--spc-gridsize', type=int, default=3)
+    group.add_argument('--spc-low-threshold', type=float, default=.2)
+    group.add_argument('--spc-high-threshold', type=float, default=1.0)
+    group.add_argument('--spc-single-threshold', type=float, default=.4)
+    group.add_argument('--spc-double-threshold', type=float, default=1.5)
+    group.add_argument('--roi', type=int, nargs=4, default=None,
+        metavar=('COL_FIRST', 'COL_LAST', 'ROW_FIRST', 'ROW_LAST'))
+    group.add_argument('--ccd-params', type=float, nargs=3,
+        default=[0.00016, 1.2, 3.6],
+        metavar=('DARK_COUNTS', 'ELECTRONS_PER_COUNT', 'ENERGY_EH'))
+
+    group = parser.add_argument_group('Background subtraction')
+    group.add_argument('--no-extract-background', dest='extract_background',
+        action='store_false')
+    group.add_argument('--dark', nargs='+', default=[],
+        help='dark images (folders or file patterns)')
+    group.add_argument('--dark-method', default='average',
+        choices=['average', 'sum', 'sum-rescaled'])
+    group.add_argument('--dark-sigma-clip', type=float, default=None,
+        metavar='SIGMA', help='reject outliers in the dark frames, e.g. '
+            'cosmic rays, beyond SIGMA standard deviations')
+    group.add_argument('--auto-dark', action='store_true',
+        help='use the best matching master dark of the library for the '
+            'exposure time and detector temperature of each image')
+    group.add_argument('--dark-library', default=None, metavar='FOLDER',
+        help='master dark library (default: ~/.rixstoolbox/darks)')
+    group.add_argument('--zero-baseline', action='store_true',
+        help='force the baseline to zero when using dark images')
+    group.add_argument('--smooth-background', type=float, default=None,
+        metavar='WIDTH', help='smooth the extracted background')
+
+    group = parser.add_argument_group('Export')
+    group.add_argument('--save-dat', action='store_true',
+        help='also save each spectrum into a *.dat file')
+    group.add_argument('--save-events', action='store_true',
+        help='also save the SPC event lists')
+    group.add_argument('--digits', type=int, default=SPEC_DIGITS,
+        help='significant digits of the spectra (default: %d)' 
+            % SPEC_DIGITS)
+    group.add_argument('--hdf5', action='store_true',
+        help='also save the spectra into an HDF5 (NeXus) file next to the '
+            '*.spec file')
+    group.add_argument('--no-spec', dest='spec', action='store_false',
+        help='do not write the *.spec file, e.g. with --hdf5')
+    group.add_argument('--profile', action='store_true',
+        help='print the time and peak memory of each reduction stage and '
+            'add them as comments to the *.spec file')
+
+    args = parser.parse_args(argv)
+
+    parameters = dict(slope=args.slope,
+        points_per_pixel=args.points_per_pixel, binning=args.binning,
+        lower_threshold=args.lower_threshold,
+        upper_threshold=args.upper_threshold, masksize=args.masksize,
+        SPC_gridsize=args.spc_gridsize,
+        SPC_low_threshold=args.spc_low_threshold,
+        SPC_high_threshold=args.spc_high_threshold,
+        SPC_single_threshold=args.spc_single_threshold,
+        SPC_double_threshold=args.spc_double_threshold,
+        roi=args.roi, ccd_params=args.ccd_params)
+
+    if not args.spec and not args.hdf5:
+        print('Nothing to save with --no-spec and without --hdf5')
+        return 1
+
+    images = list_images(args.sources)
+    darkfiles = list_images(args.dark)
+    images = [img for img in images if img not in darkfiles]
+    if not images:
+        print('No images found')
+        return 1
+
+    # Runs of consecutive images sharing the same master dark (None without
+    # dark images), converted one after the other to keep the image order
+    library = RTB_Dark.MasterDarkLibrary(args.dark_library)
+    runs, unmatched = [(None, images)], []
+    if args.auto_dark and not darkfiles:
+        runs = []
+        for img in images:
+            entry = library.match(RTB_Dark.ImageHeader(img, args.roi), 
+                args.dark_method, sigma_clip=args.dark_sigma_clip)
+            if entry is None:
+                unmatched.append(img)
+            elif runs and runs[-1][0] is entry:
+                runs[-1][1].append(img)
+            else:
+                runs.append((entry, [img]))
+        for img in unmatched:
+            print('No matching master dark found for %s' % img)
+        if not runs:
+            return 1
+
+    parameters.update(SPC=args.SPC, stream_frames=args.stream_frames,
+        precision=args.precision, extract_background=args.extract_background,
+        background_smoothing=args.smooth_background is not None,
+        background_smoothing_width=args.smooth_background or 0)
+
+    print('Converting %d images' % sum(len(run) for _, run in runs))
+    converted = 0
+    backgrounds = {}
+    for entry, run in runs:
+        if entry is not None:
+            if entry['key'] not in backgrounds:
+                backgrounds[entry['key']] = library.load(entry)
+            background, background_aqn_time = backgrounds[entry['key']]
+        elif darkfiles:
+            background, background_aqn_time = library.get(darkfiles, 
+                args.dark_method, roi=args.roi, 
+                sigma_clip=args.dark_sigma_clip)
+        else:
+            background, background_aqn_time = None, None
+        parameters.update(background=background, 
+            background_aqn_time=background_aqn_time,
+            background_force_zero=background is not None and 
+                args.zero_baseline)
+        converted += batch_convert(run, args.output, parameters, 
+            args.workers, args.save_dat, args.save_events, 
+            skip_converted=not args.force, digits=args.digits, 
+            savespecfile=args.spec, savehdf5file=args.hdf5, 
+            profile=args.profile)
+    print('%d images converted' % converted)
+    return 1 if unmatched else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+#/*##########################################################################
+# Copyright (C) 2016 K. Kummer, A. Tamborino, European Synchrotron Radiation
+# Facility
+#
+# This file is part of the ID32 RIXSToolBox developed at the ESRF by the ID32
+# staff and the ESRF Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+
+from __future__ import division
+
+__author__ = ["Kurt Kummer", "Annalisa Tamborrino"]
+__contact__ = "kurt.kummer@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+
+___doc__ = """
+    Combine dark images into the background subtracted from the RIXS images
+"""
+
+
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+
+from RixsSpectrum import RixsSpectrum
+
+
+
+class DarkImage(RixsSpectrum):
+    """
+    Dark image read like a RIXS image, inside the same ROI, but neither
+    filtered nor projected. NeXus stacks are read one frame at a time.
+    """
+    stages = RixsSpectrum.stages[:1]
+    streaming_stages = RixsSpectrum.streaming_stages[:1]
+
+    def __init__(self, imgfilename, roi=None):
+        RixsSpectrum.__init__(self, imgfilename, roi=roi, SPC=False,
+            stream_frames=True)
+
+
+    def frames(self):
+        """ (exposure time, frame) of each frame """
+        nframes = self.info['NumberOfFrames']
+        exposure = np.resize(np.ravel(self.info['ExposureTime']), nframes)
+        for frame in range(nframes):
+            if self.imageData is None:
+                yield exposure[frame], \
+                    self.read_dls_i21_frames(frame, frame+1)[:,:,0]
+            else:
+                yield exposure[frame], self.imageData[:,:,frame]
+
+
+
+class ImageHeader(DarkImage):
+    """
+    Header information (exposure time, detector size and temperature) of an
+    image or dark image, the pixels are not read
+    """
+    read_pixels = False
+
+
+
+class DarkFrameAccumulator(object):
+    """
+    Running sum, sum of squares and count of the dark frames added, so that
+    the memory needed does not grow with the number of frames. Given the
+    accumulator of a first pass, pixels further than sigma_clip standard
+    deviations from their mean (e.g. cosmic rays) are left out.
+    """
+    def __init__(self, reference=None, sigma_clip=3.):
+        self.sum = None
+        self.sumsq = None
+        self.count = 0
+        self.nframes = 0
+        self.exposure = 0.
+        self.lower, self.upper = None, None
+        if reference is not None:
+            self.reference = reference.mean()
+            std = reference.std()
+            self.lower = self.reference - sigma_clip * std
+            self.upper = self.reference + sigma_clip * std
+
+
+    def add(self, frame, exposure=0.):
+        if self.sum is None:
+            self.sum = np.zeros(frame.shape)
+            self.sumsq = np.zeros(frame.shape)
+        elif frame.shape != self.sum.shape:
+            raise ValueError('Dark frames of different size: %s and %s'
+                % (frame.shape, self.sum.shape))
+        if self.lower is not None:
+            keep = (frame >= self.lower) & (frame <= self.upper)
+            frame = np.where(keep, frame, 0.)
+            self.count = self.count + keep
+        else:
+            self.count += 1
+        self.sum += frame
+        self.sumsq += frame * frame
+        self.nframes += 1
+        self.exposure += exposure
+
+
+    def mean(self):
+        mean = self.sum / np.maximum(self.count, 1)
+        if self.lower is not None:
+            # Pixels clipped in all frames, e.g. constant ones with rounding
+            mean = np.where(self.count > 0, mean, self.reference)
+        return mean
+
+
+    def std(self):
+        count = np.maximum(self.count, 1)
+        var = self.sumsq / count - (self.sum / count)**2
+        return np.sqrt(np.maximum(var, 0.))
+
+
+
+def detector_temperature(image):
+    """
+    CCD temperature from the motors or counters of an image (the first
+    named like *temp*), None if not recorded
+    """
+    for values in (image.Motors, image.Counters or {}):
+        for name in sorted(values):
+            if 'temp' in name.lower():
+                try:
+                    return float(values[name])
+                except (TypeError, ValueError):
+                    continue
+    return None
+
+
+def iter_dark_frames(darkfiles, roi=None):
+    """ (exposure time, frame) of all frames of the dark images """
+    for fname in darkfiles:
+        for exposure, frame in DarkImage(fname, roi).frames():
+            yield exposure, frame
+
+
+def combine_dark_frames(darkfiles, method='average', roi=None,
+    sigma_clip=None):
+    """
+    Background image from the dark images, reading one frame at a time.
+    method is 'average', 'sum' or 'sum-rescaled'. With sigma_clip, outliers
+    are rejected in a second pass over the frames and the sums are rescaled
+    to the number of frames. Returns the background and, for 'sum-rescaled',
+    the total acquisition time, i.e. (None, None) without dark frames.
+    """
+    accumulator = DarkFrameAccumulator()
+    for exposure, frame in iter_dark_frames(darkfiles, roi):
+        accumulator.add(frame, exposure)
+    if accumulator.nframes == 0:
+        return None, None
+
+    if sigma_clip:
+        clipped = DarkFrameAccumulator(accumulator, sigma_clip)
+        for exposure, frame in iter_dark_frames(darkfiles, roi):
+            clipped.add(frame, exposure)
+        accumulator = clipped
+
+    if method == 'average':
+        return accumulator.mean(), None
+    if sigma_clip:
+        background = accumulator.mean() * accumulator.nframes
+    else:
+        background = accumulator.sum
+    if method == 'sum-rescaled':
+        return background, accumulator.exposure
+    return background, None
+
+
+
+def file_fingerprints(filenames):
+    """ Path, size and modification time of the files, sorted by path """
+    fingerprints = []
+    for fname in filenames:
+        stat = os.stat(fname)
+        fingerprints.append([os.path.abspath(fname), stat.st_size, 
+            stat.st_mtime])
+    return sorted(fingerprints)
+
+
+
+class MasterDarkLibrary(object):
+    """
+    Combined dark images (master darks) stored as compressed *.npz files in
+    folder, so that they are reused between sessions and programs. The 
+    index.jsonl file lists for each master dark the source files with their
+    size and modification time, the combination settings, detector size,
+    ROI, exposure time and detector temperature.
+    """
+    def __init__(self, folder=None):
+        if folder is None:
+            folder = os.path.join(os.path.expanduser('~'), '.rixstoolbox', 
+                'darks')
+        self.folder = folder
+        self.indexfile = os.path.join(folder, 'index.jsonl')
+        self.entries = {}
+        if os.path.isfile(self.indexfile):
+            with open(self.indexfile, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry['key']] = entry
+    
+    
+    def make_key(self, sources, method, roi, sigma_clip):
+        return hashlib.sha1(json.dumps([sources, method, roi, 
+            sigma_clip]).encode('utf-8')).hexdigest()
+    
+    
+    def get(self, darkfiles, method='average', roi=None, sigma_clip=None):
+        """
+        Same as combine_dark_frames, but the master dark is only computed 
+        and stored if the dark images or settings differ from all stored
+        ones
+        """
+        roi = [int(r) for r in roi] if roi is not None else None
+        sources = file_fingerprints(darkfiles)
+        key = self.make_key(sources, method, roi, sigma_clip)
+        if key in self.entries:
+            try:
+                return self.load(self.entries[key])
+            except (IOError, OSError, KeyError):
+                # Removed from the library folder
+                pass
+        background, aqn_time = combine_dark_frames(darkfiles, method, roi, 
+            sigma_clip)
+        if background is not None:
+            try:
+                self.store(key, background, darkfiles, sources, method, roi,
+                    sigma_clip)
+            except (IOError, OSError) as e:
+                print('Master dark not saved: %s' % e)
+        return background, aqn_time
+    
+    
+    def store(self, key, background, darkfiles, sources, method, roi, 
+        sigma_clip):
+        # Header information of the dark images, the pixels are not read
+        exposures, temperatures = [], []
+        for fname in darkfiles:
+            dark = ImageHeader(fname, roi)
+            exposures.extend(np.resize(np.ravel(dark.info['ExposureTime']),
+                dark.info['NumberOfFrames']).tolist())
+            temperatures.append(detector_temperature(dark))
+        temperatures = [t for t in temperatures if t is not None]
+        
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        filename = 'dark_%s.npz' % key[:16]
+        np.savez_compressed(os.path.join(self.folder, filename), 
+            background=background)
+        entry = {'key': key, 'file': filename, 'sources': sources, 
+            'method': method, 'sigma_clip': sigma_clip, 'roi': roi,
+            'detector_size': [int(dark.info['Dim_1']), 
+                int(dark.info['Dim_2'])],
+            'shape': list(background.shape),
+            'nframes': len(exposures), 
+            'exposure': float(np.mean(exposures)), 
+            'aqn_time': float(np.sum(exposures)),
+            'temperature': float(np.mean(temperatures)) 
+                if temperatures else None,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(self.indexfile, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.entries[key] = entry
+        return None
+    
+    
+    def load(self, entry):
+        with np.load(os.path.join(self.folder, entry['file'])) as data:
+            background = data['background']
+        if entry['method'] == 'sum-rescaled':
+            return background, entry['aqn_time']
+        return background, None
+    
+    
+    def find(self, image, method='average', sigma_clip=None, 
+        max_temperature_difference=2., max_exposure_difference=1.):
+        """
+        Background and, for 'sum-rescaled', acquisition time of the best
+        matching master dark for an image, see match, or (None, None)
+        """
+        entry = self.match(image, method, sigma_clip, 
+            max_temperature_difference, max_exposure_difference)
+        if entry is None:
+            return None, None
+        return self.load(entry)
+    
+    
+    def match(self, image, method='average', sigma_clip=None, 
+        max_temperature_difference=2., max_exposure_difference=1.):
+        """
+        Index entry of the best matching master dark for an image (a 
+        RixsSpectrum, DarkImage or ImageHeader): same detector size, ROI and
+        settings, closest in exposure time and detector temperature, None if
+        there is none within max_exposure_difference (s) and 
+        max_temperature_difference. 'sum-rescaled' darks are rescaled to the
+        exposure time, so any exposure time matches.
+        """
+        roi = [int(r) for r in image.roi] if image.roi is not None else None
+        size = [int(image.info['Dim_1']), int(image.info['Dim_2'])]
+        exposure = float(np.mean(image.info['ExposureTime']))
+        temperature = detector_temperature(image)
+        candidates = []
+        for entry in self.entries.values():
+            if entry['detector_size'] != size or entry['roi'] != roi or \
+                entry['method'] != method or \
+                entry['sigma_clip'] != sigma_clip:
+                continue
+            dT = 0.
+            if temperature is not None and entry['temperature'] is not None:
+                dT = abs(entry['temperature'] - temperature)
+                if dT > max_temperature_difference:
+                    continue
+            dExposure = abs(entry['exposure'] - exposure)
+            if dExposure > max_exposure_difference and \
+                method != 'sum-rescaled':
+                continue
+            if not os.path.isfile(os.path.join(self.folder, entry['file'])):
+                continue
+            candidates.append((dExposure, dT, entry))
+        if not candidates:
+            return None
+        # Closest exposure, then temperature, then the most recent
+        candidates.sort(key=lambda c: c[2]['created'], reverse=True)
+        candidates.sort(key=lambda c: (c[0], c[1]))
+        return candidates[0][2]
@@ -38,16 +38,80 @@ ___doc__ = """
     ...
 """
 
+from collections import OrderedDict
+
 import numpy as np
 
 
+# Kernels longer than this are applied by FFT, shorter ones directly
+FFT_KERNEL_SIZE = 512
+
+# Number of kernels and kernel FFTs kept in kernel_cache
+KERNEL_CACHE_SIZE = 64
+
+
+class KernelCache(object):
+    """
+    Least recently used cache of convolution kernels and their FFTs, 
+    shared by all RTB_Math instances. hits and misses count the lookups.
+    Cached arrays are read-only.
+    """
+    def __init__(self, maxsize=KERNEL_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    
+    def get(self, key, compute):
+        """ Cached value for key, compute() if not cached """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = compute()
+        value.setflags(write=False)
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+    
+    
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 
+            'size': len(self.entries), 'maxsize': self.maxsize}
+    
+    
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+kernel_cache = KernelCache()
+
+
+def quantize_sigma(sigma):
+    """ Kernel width rounded to 12 significant digits, a cache key """
+    return float('%.12g' % sigma)
+
+
+
 class RTB_Math(object):
     def gaussian_kernel_1d(self, sigma, order, radius):
         """
-        Computes a 1D Gaussian convolution kernel.
+        Computes a 1D Gaussian convolution kernel, cached in kernel_cache
+        (read-only).
         """
         if order < 0:
             raise ValueError('order must be non-negative')
+        sigma = quantize_sigma(sigma)
+        return kernel_cache.get(('gaussian', sigma, order, radius), 
+            lambda: self._gaussian_kernel_1d(sigma, order, radius))
+    
+    
+    def _gaussian_kernel_1d(self, sigma, order, radius):
         p = np.polynomial.Polynomial([0, 0, -0.5 / (sigma * sigma)])
         x = np.arange(-radius, radius + 1)
         phi_x = np.exp(p(x), dtype=np.double)
@@ -64,9 +128,45 @@ class RTB_Math(object):
     
     
     
-    def gaussian_filter(self, y, sigma, order=0, truncate=4.0):
+    def correlate1d(self, y, weights, axis=-1, key=None):
+        """
+        Correlates a 1D array or each 1D slice along axis of an N-D array
+        with weights (odd length). The input is mirrored at its edges by one
+        kernel radius. Kernels longer than FFT_KERNEL_SIZE are applied by 
+        FFT to all slices at once, the FFT of the weights is cached in 
+        kernel_cache if a key identifying them is given.
+        """
+        y = np.moveaxis(np.asarray(y, dtype=float), axis, -1)
+        n = y.shape[-1]
+        radius = len(weights) // 2
+        ypad = np.pad(y, [(0, 0)] * (y.ndim - 1) + [(radius, radius)], 
+            mode='symmetric')
+        if len(weights) > FFT_KERNEL_SIZE:
+            # No wrap-around in the valid part for nfft >= padded length
+            nfft = 2**int(np.ceil(np.log2(ypad.shape[-1])))
+            if key is None:
+                fft_weights = np.fft.rfft(weights[::-1], nfft)
+            else:
+                fft_weights = kernel_cache.get(('fft', key, nfft), 
+                    lambda: np.fft.rfft(weights[::-1], nfft))
+            retval = np.fft.irfft(np.fft.rfft(ypad, nfft, axis=-1) * 
+                fft_weights, nfft, axis=-1)
+            retval = retval[..., len(weights)-1:len(weights)-1+n]
+        else:
+            rows = ypad.reshape(-1, ypad.shape[-1])
+            retval = np.empty((len(rows), n))
+            for i, row in enumerate(rows):
+                retval[i] = np.correlate(row, weights, mode='valid')
+            retval = retval.reshape(y.shape)
+        return np.moveaxis(retval, -1, axis)
+    
+    
+    
+    def gaussian_filter(self, y, sigma, order=0, truncate=4.0, axis=-1):
         """
-        Applies a Gaussian filter to a 1D input array.
+        Applies a Gaussian filter to a 1D input array, or along axis to
+        all spectra of a 2D array at once. Points closer to the edges than 
+        the kernel radius are left unfiltered.
         Adapted from scipy.ndimage
         """
         if abs(sigma) < 1e-15:
@@ -75,13 +175,12 @@ class RTB_Math(object):
             sd = float(sigma)
             lw = int(truncate * sd + 0.5)
             weights = self.gaussian_kernel_1d(sigma, order, lw)[::-1]
-            ytemp = np.hstack((len(weights)//len(y)+1)*[y, y[::-1],y, y[::-1]] 
-                + [y] + (len(weights)//len(y)+1)*[y[::-1], y, y[::-1], y])
-            retval = np.correlate(ytemp, weights, mode='same')
-            retval = retval[(len(weights)//len(y)+1)*4*len(y):
-                ((len(weights)//len(y)+1)*4+1)*len(y)]
-            retval[:len(weights)//2] = y[:len(weights)//2]
-            retval[-len(weights)//2:] = y[-len(weights)//2:]
+            retval = self.correlate1d(y, weights, axis, 
+                key=('gaussian_filter', quantize_sigma(sigma), order, lw))
+            out = np.moveaxis(retval, axis, -1)
+            y = np.moveaxis(np.asarray(y), axis, -1)
+            out[..., :len(weights)//2] = y[..., :len(weights)//2]
+            out[..., -len(weights)//2:] = y[..., -len(weights)//2:]
         return retval
     
     
@@ -90,6 +189,53 @@ class RTB_Math(object):
         return amp*np.exp(-(x-x0)**2/2/(fwhm/2.3548)**2)
     
     
+    def gaussian_jacobian(self, x, x0, amp, fwhm):
+        """ Derivatives of gaussian by x0, amp and fwhm (last axis) """
+        s = fwhm / 2.3548
+        dx = x - x0
+        g = np.exp(-dx**2/2/s**2)
+        f = amp * g
+        return np.stack([f*dx/s**2, g, f*dx**2/s**3/2.3548], axis=-1)
+    
+    
+    def lorentzian(self, x, x0, amp, fwhm):
+        return amp / (1 + (2*(x-x0)/fwhm)**2)
+    
+    
+    def lorentzian_jacobian(self, x, x0, amp, fwhm):
+        """ Derivatives of lorentzian by x0, amp and fwhm (last axis) """
+        u = 2*(x-x0)/fwhm
+        l = 1 / (1 + u**2)
+        return np.stack([4*amp*u*l**2/fwhm, l, 2*amp*u**2*l**2/fwhm], 
+            axis=-1)
+    
+    
+    def pseudo_voigt(self, x, x0, amp, fwhm, eta):
+        """ Sum of a Lorentzian (fraction eta) and a Gaussian, same FWHM """
+        return eta*self.lorentzian(x, x0, amp, fwhm) + \
+            (1-eta)*self.gaussian(x, x0, amp, fwhm)
+    
+    
+    def pseudo_voigt_jacobian(self, x, x0, amp, fwhm, eta):
+        """ Derivatives of pseudo_voigt by x0, amp, fwhm and eta (last axis) """
+        jl = self.lorentzian_jacobian(x, x0, amp, fwhm)
+        jg = self.gaussian_jacobian(x, x0, amp, fwhm)
+        eta = np.asarray(eta)[...,np.newaxis]
+        # Derivatives by amp are the unit height shapes
+        return np.concatenate([eta*jl + (1-eta)*jg, 
+            (amp*(jl[...,1]-jg[...,1]))[...,np.newaxis]], axis=-1)
+    
+    
+    def analytic_jacobian(self, theory):
+        """ Jacobian of the built-in peak shapes, None for other functions """
+        jacobians = {
+            RTB_Math.gaussian: self.gaussian_jacobian,
+            RTB_Math.lorentzian: self.lorentzian_jacobian,
+            RTB_Math.pseudo_voigt: self.pseudo_voigt_jacobian,
+            }
+        return jacobians.get(getattr(theory, '__func__', None))
+    
+    
     
     def minimize(self, func, x0, args=(), xatol=1e-4, fatol=1e-4, maxiter=None, 
                     maxfev=None, disp=1):
@@ -121,7 +267,7 @@ class RTB_Math(object):
         nonzdelt = 0.05
         zdelt = 0.00025
     
-        x0 = np.asfarray(x0).flatten()
+        x0 = np.asarray(x0, dtype=float).flatten()
     
         
         N = len(x0)
@@ -254,17 +400,348 @@ class RTB_Math(object):
         return x, result
     
     
-    def curve_fit(self, theory, x, y, p0=(1, 1, 1)):
+    def curve_fit(self, theory, x, y, p0=(1, 1, 1), jac=None, sigma=None,
+            maxiter=200, xtol=1e-10, ftol=1e-10, full_output=False):
         """
-        Covinience function for curve fitting.
+        Least-squares fit of theory(x, *p) to y with the Levenberg-Marquardt
+        algorithm. jac(x, *p) returns the derivatives of theory by the 
+        parameters as columns, for the built-in peak shapes (gaussian, ...)
+        it is known, otherwise derived numerically. sigma are the 
+        uncertainties of y. Returns the parameters and their covariance, 
+        scaled by the reduced chi-square like scipy.optimize.curve_fit, and
+        with full_output a dictionary with the parameter uncertainties 
+        (perr), chisq, nfev, nit, success and message.
         """
-        def func2minimize(p0, theory, data):
-            return ((data[:,1]-theory(data[:,0], *p0))**2).sum()
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        p = np.array(p0, dtype=float)
+        weights = np.ones_like(y) if sigma is None else \
+            1. / np.asarray(sigma, dtype=float)
+        if jac is None:
+            jac = self.analytic_jacobian(theory)
+        if jac is None:
+            def jac(x, *p):
+                # Forward differences
+                f0 = theory(x, *p)
+                columns = []
+                for k in range(len(p)):
+                    step = 1.49e-8 * max(abs(p[k]), 1.)
+                    pk = np.array(p)
+                    pk[k] += step
+                    columns.append((theory(x, *pk) - f0) / step)
+                return np.column_stack(columns)
         
-        popt, msg = self.minimize(func2minimize, x0=p0, 
-                    args=(theory, np.vstack([x, y]).T), disp=False)
-        return popt, msg
-    
+        nfev = 1
+        r = weights * (y - theory(x, *p))
+        chisq = r.dot(r)
+        lam = 1e-3
+        success = False
+        message = 'Maximum number of iterations has been exceeded.'
+        for nit in range(1, maxiter+1):
+            J = weights[:,np.newaxis] * jac(x, *p)
+            A = J.T.dot(J)
+            g = J.T.dot(r)
+            scale = np.maximum(np.diag(A), 1e-30)
+            while lam < 1e16:
+                try:
+                    dp = np.linalg.solve(A + lam*np.diag(scale), g)
+                except np.linalg.LinAlgError:
+                    lam *= 10
+                    continue
+                pnew = p + dp
+                rnew = weights * (y - theory(x, *pnew))
+                chisqnew = rnew.dot(rnew)
+                nfev += 1
+                if np.isfinite(chisqnew) and chisqnew <= chisq:
+                    break
+                lam *= 10
+            else:
+                success = True
+                message = 'No further reduction of the sum of squares.'
+                break
+            lam = max(lam / 10, 1e-12)
+            p, r, chisq_old, chisq = pnew, rnew, chisq, chisqnew
+            if chisq_old - chisq <= ftol * chisq_old:
+                success = True
+                message = 'Relative reduction of the sum of squares ' \
+                    'below ftol.'
+                break
+            if np.all(np.abs(dp) <= xtol * (np.abs(p) + xtol)):
+                success = True
+                message = 'Relative change of the parameters below xtol.'
+                break
+        
+        # Covariance at the solution
+        J = weights[:,np.newaxis] * jac(x, *p)
+        dof = len(y) - len(p)
+        try:
+            pcov = np.linalg.inv(J.T.dot(J))
+            if sigma is None:
+                pcov *= chisq / dof if dof > 0 else np.inf
+        except np.linalg.LinAlgError:
+            pcov = np.full((len(p), len(p)), np.inf)
+        if not full_output:
+            return p, pcov
+        info = dict(perr=np.sqrt(np.abs(np.diag(pcov))), chisq=chisq, 
+            nfev=nfev, nit=nit, success=success, message=message)
+        return p, pcov, info
+    
+    
+    
+    # Peak shapes for curve_fit_batch: function name, parameter names
+    peak_models = {
+        'gaussian': ('gaussian', ['x0', 'amp', 'fwhm']),
+        'lorentzian': ('lorentzian', ['x0', 'amp', 'fwhm']),
+        'pseudo_voigt': ('pseudo_voigt', ['x0', 'amp', 'fwhm', 'eta']),
+        }
+    
+    
+    def pad_curves(self, xs, ys):
+        """
+        Stack curves of different lengths into 2D arrays x and y for 
+        curve_fit_batch, padded with the last x and zero y. Returns x, y 
+        and the mask of the valid points.
+        """
+        npoints = max(len(x) for x in xs)
+        x = np.zeros((len(xs), npoints))
+        y = np.zeros((len(xs), npoints))
+        mask = np.zeros((len(xs), npoints), dtype=bool)
+        for i, (xi, yi) in enumerate(zip(xs, ys)):
+            n = len(xi)
+            x[i,:n] = xi
+            x[i,n:] = xi[-1] if n else 0
+            y[i,:n] = yi
+            mask[i,:n] = True
+        return x, y, mask
+    
+    
+    def estimate_peaks(self, x, y, mask=None):
+        """
+        Starting values (x0, amp, fwhm) for each row of y: position and
+        height of the maximum, width from the number of points above half 
+        of it
+        """
+        y = np.atleast_2d(y)
+        x = np.broadcast_to(x, y.shape)
+        mask = np.ones(y.shape, dtype=bool) if mask is None else \
+            np.broadcast_to(mask, y.shape)
+        ymasked = np.where(mask, y, -np.inf)
+        imax = ymasked.argmax(axis=1)
+        rows = np.arange(len(y))
+        amp = ymasked[rows, imax]
+        npoints = np.maximum(mask.sum(axis=1), 2)
+        with np.errstate(invalid='ignore'):
+            step = (np.where(mask, x, -np.inf).max(axis=1) - 
+                np.where(mask, x, np.inf).min(axis=1)) / (npoints - 1)
+        above = (ymasked > 0.5 * amp[:,np.newaxis]).sum(axis=1)
+        fwhm = np.maximum(above, 1) * step
+        return np.column_stack([x[rows, imax], amp, fwhm])
+    
+    
+    def curve_fit_batch(self, x, y, model='gaussian', p0=None, mask=None,
+            maxiter=200, xtol=1e-10, ftol=1e-10):
+        """
+        Fits a peak model ('gaussian', 'lorentzian' or 'pseudo_voigt') to
+        every row of the 2D array y at once with the Levenberg-Marquardt
+        algorithm (see curve_fit), each row with its own damping. x is 
+        shared (1D) or given per row (2D), mask selects the valid points
+        (see pad_curves). p0 are the starting values per row, estimated if
+        None. Returns the parameters (rows x parameters), their covariance
+        and a dictionary with the uncertainties (perr), chisq, nit and the
+        per row flag converged.
+        """
+        funcname, parnames = self.peak_models[model]
+        theory = getattr(self, funcname)
+        jac = getattr(self, funcname + '_jacobian')
+        y = np.atleast_2d(np.asarray(y, dtype=float))
+        nrows, npoints = y.shape
+        x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+        weights = np.ones(y.shape) if mask is None else \
+            np.broadcast_to(mask, y.shape).astype(float)
+        # Points without data do not count
+        missing = ~np.isfinite(y)
+        if missing.any():
+            weights[missing] = 0
+            y = np.where(missing, 0, y)
+        if p0 is None:
+            p0 = self.estimate_peaks(x, y, weights > 0)
+            if model == 'pseudo_voigt':
+                p0 = np.column_stack([p0, np.full(nrows, 0.5)])
+        p = np.array(np.broadcast_to(p0, (nrows, len(parnames))), dtype=float)
+        nparams = p.shape[1]
+        
+        # Both for the given rows only
+        def residuals(p, rows):
+            with np.errstate(all='ignore'):
+                r = weights[rows] * (y[rows] - 
+                    theory(x[rows], *p.T[:,:,np.newaxis]))
+            return r, np.einsum('ij,ij->i', r, r)
+        
+        def jacobian(p, rows):
+            return weights[rows,:,np.newaxis] * \
+                jac(x[rows], *p.T[:,:,np.newaxis])
+        
+        def solve(A, b):
+            try:
+                return np.linalg.solve(A, b[:,:,np.newaxis])[:,:,0]
+            except np.linalg.LinAlgError:
+                # Singular rows one by one, no step if not solvable
+                x = np.full(b.shape, np.nan)
+                for i in range(len(A)):
+                    try:
+                        x[i] = np.linalg.lstsq(A[i], b[i], rcond=None)[0]
+                    except np.linalg.LinAlgError:
+                        pass
+                return x
+        
+        def invert(A):
+            try:
+                return np.linalg.inv(A)
+            except np.linalg.LinAlgError:
+                inverse = np.full(A.shape, np.inf)
+                for i in range(len(A)):
+                    try:
+                        inverse[i] = np.linalg.inv(A[i])
+                    except np.linalg.LinAlgError:
+                        pass
+                return inverse
+        
+        r, chisq = residuals(p, slice(None))
+        lam = np.full(nrows, 1e-3)
+        nit = np.zeros(nrows, dtype=int)
+        dof = weights.sum(axis=1) - nparams
+        # Rows without enough points are not fitted
+        active = dof > 0
+        converged = np.zeros(nrows, dtype=bool)
+        diag = np.arange(nparams)
+        for iteration in range(maxiter):
+            if not active.any():
+                break
+            rows = np.flatnonzero(active)
+            J = jacobian(p[rows], rows)
+            A = np.einsum('ijk,ijl->ikl', J, J)
+            g = np.einsum('ijk,ij->ik', J, r[rows])
+            scale = np.maximum(A[:,diag,diag], 1e-30)
+            A[:,diag,diag] += lam[rows,np.newaxis] * scale
+            dp = solve(A, g)
+            pnew = p[rows] + dp
+            rnew, chisqnew = residuals(pnew, rows)
+            nit[rows] += 1
+            better = np.isfinite(chisqnew) & (chisqnew <= chisq[rows])
+            
+            # Rejected steps: more damping, give up when no step helps
+            worse = rows[~better]
+            lam[worse] *= 10
+            stuck = worse[lam[worse] >= 1e16]
+            converged[stuck] = True
+            active[stuck] = False
+            
+            # Accepted steps
+            accepted = rows[better]
+            if len(accepted):
+                small = (chisq[accepted] - chisqnew[better] <= 
+                    ftol * chisq[accepted]) | np.all(np.abs(dp[better]) <= 
+                    xtol * (np.abs(pnew[better]) + xtol), axis=1)
+                p[accepted] = pnew[better]
+                r[accepted] = rnew[better]
+                chisq[accepted] = chisqnew[better]
+                lam[accepted] = np.maximum(lam[accepted] / 10, 1e-12)
+                converged[accepted[small]] = True
+                active[accepted[small]] = False
+        
+        # Covariance at the solution, scaled by the reduced chi-square
+        pcov = np.full((nrows, nparams, nparams), np.inf)
+        fitted = dof > 0
+        if fitted.any():
+            J = jacobian(p[fitted], fitted)
+            A = np.einsum('ijk,ijl->ikl', J, J)
+            cov = invert(A)
+            with np.errstate(invalid='ignore'):
+                cov *= (chisq[fitted] / dof[fitted])[:,np.newaxis,np.newaxis]
+            pcov[fitted] = cov
+        perr = np.sqrt(np.abs(pcov[:,diag,diag]))
+        info = dict(perr=perr, chisq=chisq, nit=nit, converged=converged, 
+            parameters=parnames)
+        return p, pcov, info
+    
+    
+    def robust_line_fit(self, x, y, loss='huber', c=2., scale=1., 
+            maxiter=500, tol=1e-10):
+        """
+        Fits the line y = p[0] + p[1] * x by iteratively reweighted least 
+        squares with 'huber' or 'tukey' (biweight) weights, each step 
+        solving the 2x2 weighted normal equations. c is the threshold for
+        the residuals divided by scale, which is estimated from the median
+        absolute deviation if None. Tukey fits start from the Huber fit.
+        Returns p and a dictionary with the uncertainties (perr), the 
+        fraction of residuals within the threshold (inliers), the scale,
+        nit and converged.
+        """
+        x = np.ravel(np.asarray(x, dtype=float))
+        y = np.ravel(np.asarray(y, dtype=float))
+        valid = np.isfinite(x) & np.isfinite(y)
+        x, y = x[valid], y[valid]
+        info = dict(perr=np.full(2, np.inf), inliers=0., scale=scale, nit=0,
+            converged=False)
+        
+        def solve(w):
+            sw, swx, swy = w.sum(), (w * x).sum(), (w * y).sum()
+            swxx, swxy = (w * x * x).sum(), (w * x * y).sum()
+            det = sw * swxx - swx * swx
+            if not sw > 0 or not det > 0:
+                return None
+            slope = (sw * swxy - swx * swy) / det
+            return np.array([(swy - slope * swx) / sw, slope])
+        
+        def weights(u, loss):
+            if loss == 'tukey':
+                return np.where(u < 1, (1 - u * u)**2, 0.)
+            return 1. / np.maximum(u, 1)
+        
+        if loss not in ('huber', 'tukey'):
+            raise ValueError('Unknown loss %r' % loss)
+        p = solve(np.ones(x.size))
+        if p is None:
+            return np.full(2, np.nan), info
+        if scale is None:
+            r = y - p[0] - p[1] * x
+            scale = 1.4826 * np.median(np.abs(r - np.median(r)))
+            scale = scale if scale > 0 else 1.
+        
+        nit = 0
+        for step in (['huber', 'tukey'] if loss == 'tukey' else ['huber']):
+            converged = False
+            for i in range(maxiter):
+                nit += 1
+                u = np.abs(y - p[0] - p[1] * x) / (c * scale)
+                pnew = solve(weights(u, step))
+                if pnew is None:
+                    break
+                converged = np.all(np.abs(pnew - p) <= 
+                    tol * (np.abs(p) + tol))
+                p = pnew
+                if converged:
+                    break
+        
+        # Asymptotic covariance of M-estimators (Huber 1981):
+        # s^2 * mean(psi^2) / mean(psi')^2 * (X^T X)^-1
+        u = (y - p[0] - p[1] * x) / (c * scale)
+        inside = np.abs(u) < 1
+        if loss == 'tukey':
+            psi = u * (1 - u * u)**2 * inside
+            dpsi = (1 - u * u) * (1 - 5 * u * u) * inside
+        else:
+            psi = np.clip(u, -1, 1)
+            dpsi = 1. * inside
+        n = x.size
+        if n > 2 and dpsi.mean() > 0:
+            s2 = (c * scale)**2 * (psi * psi).sum() / (n - 2) / \
+                dpsi.mean()**2
+            det = n * (x * x).sum() - x.sum()**2
+            info['perr'] = np.sqrt(s2 * np.array([(x * x).sum(), n]) / det)
+        info.update(inliers=inside.mean(), scale=scale, nit=nit, 
+            converged=bool(converged))
+        return p, info
     
     
     def interpolate_on_grid(self, qvals, xvals, yvals, grid, method='nearest', 
@@ -563,7 +563,8 @@ class MainWindow(qt.QWidget):
                 self._plotSpectraWindow.addCurve(x, y, legend=legend, info=info, 
                     color='grey', linestyle='--', symbol='.')
                 gw = self.polGaussSpinBox.value() * len(x) / (x[-1] - x[0]) / 2.35482 # Assuming equidistance
-                self._plotSpectraWindow.addCurve(x, self.RTB_Math.gaussian_filter(y, gw),
+                ybroad = self.RTB_Math.gaussian_filter(y, gw)
+                self._plotSpectraWindow.addCurve(x, ybroad,
                     legend='Polarised beam broadened', color='grey', 
                     replot=True, linestyle='-')
                 
@@ -571,7 +572,7 @@ class MainWindow(qt.QWidget):
                 self._plotSpectraWindow.addCurve(x, y/avg_refl, 
                     legend='Polarised beam renormalized to average multilayer reflectivity',
                     color='green', linestyle='--', symbol='.')
-                self._plotSpectraWindow.addCurve(x, self.RTB_Math.gaussian_filter(y, gw)/avg_refl,
+                self._plotSpectraWindow.addCurve(x, ybroad/avg_refl,
                     legend='Polarised beam broad renormalized to average multilayer reflectivity', color='green', 
                     replot=True, linestyle='-')
                     
@@ -624,8 +625,10 @@ class MainWindow(qt.QWidget):
         self._plotSpectraWindow.addCurve(x, hor, legend='pi out', color='blue', linestyle='--', symbol='.')
         self._plotSpectraWindow.addCurve(x, ver, legend='sigma out', color='red', replot=True, linestyle='--', symbol='.')
         
-        self._plotSpectraWindow.addCurve(x, self.RTB_Math.gaussian_filter(hor, self.postGaussWidthSpinBox.value()), legend='pi out Gaussian', color='blue', linestyle='-')
-        self._plotSpectraWindow.addCurve(x, self.RTB_Math.gaussian_filter(ver, self.postGaussWidthSpinBox.value()), legend='sigma out Gaussian', color='red', linestyle='-')
+        hor_smooth, ver_smooth = self.RTB_Math.gaussian_filter(
+            np.vstack([hor, ver]), self.postGaussWidthSpinBox.value())
+        self._plotSpectraWindow.addCurve(x, hor_smooth, legend='pi out Gaussian', color='blue', linestyle='-')
+        self._plotSpectraWindow.addCurve(x, ver_smooth, legend='sigma out Gaussian', color='red', linestyle='-')
         
         
     
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+#/*##########################################################################
+# Copyright (C) 2016 K. Kummer, A. Tamborino, European Synchrotron Radiation
+# Facility
+#
+# This file is part of the ID32 RIXSToolBox developed at the ESRF by the ID32
+# staff and the ESRF Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+
+from __future__ import division
+
+__author__ = ["Kurt Kummer", "Annalisa Tamborrino"]
+__contact__ = "kurt.kummer@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+
+___doc__ = """
+    Check that images processed in single precision (--float32) give the
+    same spectra as in double precision, on a synthetic image or on the
+    images given, e.g.
+
+    python RTB_PrecisionCheck.py
+    python RTB_PrecisionCheck.py /data/Images/sample_0042.edf --slope -0.0395
+"""
+
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from PyMca5.PyMcaIO import EdfFile
+
+from RixsSpectrum import check_precision, FLOAT32_TOLERANCE
+
+
+
+def write_synthetic_image(fname, nrows=1024, ncols=512, slope=-.02,
+    nphotons=2000, seed=0):
+    """
+    ID32 like EDF image with a constant dark level, read-out noise, photons
+    on two lines tilted by slope and a few cosmic rays
+    """
+    rng = np.random.default_rng(seed)
+    energy = 931.2
+    # Counts of one photon, see RixsSpectrum.filter_image
+    photon = energy / 3.6 / 1.2
+    image = rng.normal(300., 3., (nrows, ncols))
+    for k in range(nphotons):
+        col = rng.integers(2, ncols - 2)
+        row = (.3 if k % 2 else .6) * nrows + rng.normal(0., 3.) + slope*col
+        row = int(row) % (nrows - 4) + 2
+        spread = np.array([[.02, .05, .02], [.05, .7, .05], [.02, .05, .04]])
+        image[row-1:row+2, col-1:col+2] += photon * rng.uniform(.8, 1.2) * \
+            spread * rng.uniform(.7, 1.3, (3, 3))
+    for k in range(5):
+        image[rng.integers(5, nrows - 5), rng.integers(5, ncols - 5)] += \
+            50 * photon
+    header = {'motor_mne': 'energy tth th chi phi',
+        'motor_pos': '%s 150.0 20.5 0.1 -0.2' % energy,
+        'counter_mne': 'srcur mir sam', 'counter_pos': '199.5 1.5e5 2.5e5',
+        'count_time': '30.0', 'run': '1', 'scan_no': '1', 'point_no': '1',
+        'dir': os.path.dirname(os.path.abspath(fname))}
+    if os.path.exists(fname):
+        os.remove(fname)
+    edf = EdfFile.EdfFile(fname, 'wb')
+    edf.WriteImage(header, np.round(image).astype(np.uint16), Append=0)
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare the spectra of images processed in single and '
+            'double precision')
+    parser.add_argument('images', nargs='*',
+        help='images to check (default: a synthetic image)')
+    parser.add_argument('--tolerance', type=float, default=FLOAT32_TOLERANCE,
+        help='largest deviation allowed relative to the maximum of each '
+            'spectrum (default: %g)' % FLOAT32_TOLERANCE)
+    parser.add_argument('--slope', type=float, default=-.02)
+    args = parser.parse_args(argv)
+
+    folder = None
+    images = args.images
+    if not images:
+        folder = tempfile.mkdtemp()
+        images = [os.path.join(folder, 'synthetic_0001.edf')]
+        write_synthetic_image(images[0], slope=args.slope)
+
+    settings = [('default', dict()), ('no SPC', dict(SPC=False)),
+        ('ROI', dict(roi=[50, 450, 100, 900])),
+        ('no thresholds', dict(lower_threshold=-1e5, upper_threshold=1e5,
+            masksize=5))]
+    failed = 0
+    try:
+        for imgfilename in images:
+            for name, parameters in settings:
+                try:
+                    deviations = check_precision(imgfilename,
+                        args.tolerance, slope=args.slope, **parameters)
+                except AssertionError as e:
+                    print('FAILED %s %s: %s' % (imgfilename, name, e))
+                    failed += 1
+                    continue
+                worst = max(deviations, key=deviations.get)
+                print('OK %s %s: largest deviation %.3g in column %s' % (
+                    imgfilename, name, deviations[worst], worst))
+    finally:
+        if folder is not None:
+            shutil.rmtree(folder, ignore_errors=True)
+    return 1 if failed else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
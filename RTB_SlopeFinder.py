@@ -83,6 +83,12 @@ class MainWindow(qt.QWidget):
         self.extractButton.resize(120, 65)
         self.extractButton.setMinimumSize(120, 65)
         self.extractButton.setMaximumSize(120, 65)
+        self.optimiseButton = qt.QPushButton('Optimise slope\nfrom spectra')
+        self.optimiseButton.setToolTip(
+            'Slope giving the sharpest elastic line in the projected spectra')
+        self.optimiseButton.resize(120, 65)
+        self.optimiseButton.setMinimumSize(120, 65)
+        self.optimiseButton.setMaximumSize(120, 65)
         
         
         self.parametersWidget = SpecGenGUI.ParametersWidget(self)
@@ -112,6 +118,7 @@ class MainWindow(qt.QWidget):
         rsLayout.addWidget(self.tabWidget, 0, 0, 1, 1)
         rsLayout.addWidget(plotWidget, 1, 0, 10, 2)
         rsLayout.addWidget(self.extractButton, 0, 2, 1, 1)
+        rsLayout.addWidget(self.optimiseButton, 0, 3, 1, 1)
         rsLayout.addWidget(tableBox, 1, 2, 10, 2)
         rsLayout.setSpacing(10)
         rsWidget = qt.QWidget()
@@ -136,6 +143,8 @@ class MainWindow(qt.QWidget):
         self.setLayout(mainLayout)
         
         self.RTB_Math = RTB_Math()
+        # Reduced images are kept and only updated when the parameters change
+        self.rixsSpectra = {}
         
         # Initial parameters
         self.parametersWidget._slopeDoubleSpinBox.setValue(self.slope)
@@ -160,18 +169,21 @@ class MainWindow(qt.QWidget):
         self.SPC_double_threshold = 1.5
         self.ROI = None
         self.ccd_parameters = [0.00016, 1.2, 3.6]
+        self.sweepCentre = 0. # Last slope estimated from the images
+        self.sweepRange = 0.03 # Slopes within sweepCentre +/- sweepRange
+        self.sweepStep = 0.001
+        self.sweepShifts = 3 # Times the range is moved if FWHM min at edge
         return 0
     
     def connect_signals(self):
         self.extractButton.clicked.connect(self.specgen)
+        self.optimiseButton.clicked.connect(self.optimiseslope)
         self.parametersWidget.ExpertSettingsButtonClicked.connect(
             self.expertsettings)
         self._sourcefilesWidget.DarkImagesAdded.connect(
             self.backgroundWidget.addDarkImages)
         self._sourcefilesWidget.DarkImagesRemoved.connect(
             self.backgroundWidget.removeDarkImages)
-        self.backgroundWidget.DarkImagesViewModelChanged.connect(
-            self.get_dark_images)
     
     def update_parameters(self):
         self.points_per_pixel = \
@@ -197,88 +209,189 @@ class MainWindow(qt.QWidget):
         self.SPC = self._parametersWidget._spcCheckBox.isChecked()
     
     
-    def get_dark_images(self):
-        self.darkImages = []
-        for fname in self.backgroundWidget.darkImagesList:
-            x = RixsSpectrum(fname, slope=self.slope, 
-                        points_per_pixel=self.points_per_pixel, 
-                        binning=self.binning,
-                        lower_threshold=self.lower_threshold, 
-                        upper_threshold=self.upper_threshold, 
-                        masksize=self.masksize, 
-                        SPC=False, SPC_gridsize=self.SPC_gridsize, 
-                        SPC_low_threshold=self.SPC_low_threshold, 
-                        SPC_high_threshold=self.SPC_high_threshold, 
-                        SPC_single_threshold=self.SPC_single_threshold, 
-                        SPC_double_threshold=self.SPC_double_threshold, 
-                        roi=self.ROI, ccd_params=self.ccd_parameters,
-                        extract_background=True, background='off'
-                        )
-            for frame in range(len(x.spectrum)):
-                self.darkImages.append((x.info['ExposureTime'][frame], 
-                                        x.rawImageData[:,:,frame]))
-    
-    
-    def specgen(self):
-        self.update_parameters()
-        #self._update_expertsetting()
-        
+    def update_background(self):
         self.background = None
         self.backgroundAcquisitionTime = None
         self.backgroundForceZero = False
         
         if self.backgroundWidget.useDarkImagesCheckBox.isChecked():
-            if self.darkImages:
-                if self.backgroundWidget.methodComboBox.currentIndex() == 0: #Average
-                    self.background = np.dstack(
-                        [img[1] for img in self.darkImages]).mean(axis=2)
-                else: # Sum
-                    self.background = np.dstack(
-                        [img[1] for img in self.darkImages]).sum(axis=2)
-                if self.backgroundWidget.methodComboBox.currentIndex() == 2: #Sum rescaled to acquistion time
-                    self.backgroundAcquisitionTime = sum(
-                        [img[0] for img in self.darkImages])
-                if self.backgroundWidget.zeroBaselineCheckBox.isChecked():
-                    self.backgroundForceZero = True
-        
+            self.background, self.backgroundAcquisitionTime = \
+                self.backgroundWidget.get_dark_background(self.ROI)
+            if self.background is not None and \
+                self.backgroundWidget.zeroBaselineCheckBox.isChecked():
+                self.backgroundForceZero = True
+    
+    
+    def reduction_parameters(self):
+        return dict(slope=self.slope, points_per_pixel=self.points_per_pixel, binning=self.binning,
+            lower_threshold=self.lower_threshold, upper_threshold=self.upper_threshold, 
+            masksize=self.masksize, SPC=self.SPC, SPC_gridsize=self.SPC_gridsize, SPC_low_threshold=self.SPC_low_threshold, SPC_high_threshold=self.SPC_high_threshold, 
+            SPC_single_threshold=self.SPC_single_threshold, SPC_double_threshold=self.SPC_double_threshold, roi=self.ROI, ccd_params=self.ccd_parameters,
+            extract_background=self.backgroundWidget.extractBackgroundCheckBox.isChecked(), 
+            background=self.background, background_aqn_time=self.backgroundAcquisitionTime,
+            background_force_zero=self.backgroundForceZero, 
+            keep_raw_image=True)
+    
+    
+    def get_rixs_spectrum(self, f, parameters, rixsSpectra):
+        # Reuse the already reduced images, only changed stages are re-run
+        if f in self.rixsSpectra:
+            rxs = self.rixsSpectra[f]
+            rxs.update(**parameters)
+        else:
+            rxs = RixsSpectrum(f, **parameters)
+        rixsSpectra[f] = rxs
+        return rxs
+    
+    
+    def specgen(self):
+        self.update_parameters()
+        #self._update_expertsetting()
+        self.update_background()
         
         fnames = [i.data(0) for i in 
             self._sourcefilesWidget.sourceView.selectedIndexes()]
         
         self.tableWidget.table.setRowCount(len(fnames))
         self.spcPlot.clearCurves()
+        self.spcPlot.setGraphTitle('Photon positions')
         self._specarithmetic= SpecArithmetic()
         colors = self.spcPlot.colorList
         
         opt_slopes = []
         
+        parameters = self.reduction_parameters()
+        
         nframes = 0
+        rixsSpectra = {}
         for i, fname in enumerate(fnames):
             f = '/'.join([self._sourcefilesWidget.sourceFolder, fname])
-            self.rxs = RixsSpectrum(f, slope=self.slope, points_per_pixel=self.points_per_pixel, binning=self.binning,
-                lower_threshold=self.lower_threshold, upper_threshold=self.upper_threshold, 
-                masksize=self.masksize, SPC=self.SPC, SPC_gridsize=self.SPC_gridsize, SPC_low_threshold=self.SPC_low_threshold, SPC_high_threshold=self.SPC_high_threshold, 
-                SPC_single_threshold=self.SPC_single_threshold, SPC_double_threshold=self.SPC_double_threshold, roi=self.ROI, ccd_params=self.ccd_parameters,
-                extract_background=self.backgroundWidget.extractBackgroundCheckBox.isChecked(), 
-                background=self.background, background_aqn_time=self.backgroundAcquisitionTime,
-                background_force_zero=self.backgroundForceZero)
+            self.rxs = self.get_rixs_spectrum(f, parameters, rixsSpectra)
             
             for framenumber in range(len(self.rxs.spectrum)):
                 self.tableWidget.table.setItem(nframes, 0, 
                     qt.QTableWidgetItem('%s : %04d' % (fname, framenumber)))
                 nframes += 1
                 xfit = np.arange(self.rxs.imageData[:,:,framenumber].shape[1])
-                theta2 = self.RTB_Math.minimize(self.total_huber_loss, [0,0], disp=False)[0]
+                theta2 = self.fit_centroids()[0]
                 self.spcPlot.addCurve(self.rxs.cp[0][:,1],self.rxs.cp[0][:,0],'Original data %s' %fname, color=colors[i%len(colors)], symbol='x', linestyle=' ', replot=True)
                 self.spcPlot.addCurve(xfit, theta2[0] + theta2[1] * xfit,'Fitted line %s slope= %.4f' %(fname,theta2[1]), color=colors[i%len(colors)], linestyle='-', replot=True)
                 self.spcPlot.replot()
                 self.tableWidget.table.setItem(i, 1, qt.QTableWidgetItem('%.4f' %theta2[1]))
                 opt_slopes.append(theta2[1])
+        
+        # Only keep the currently selected images
+        self.rixsSpectra = rixsSpectra
+        if opt_slopes:
+            self.sweepCentre = float(np.mean(opt_slopes))
             
-        # Mean values
+        self.show_mean_slope(opt_slopes)
+        return
+    
+    
+    def optimiseslope(self):
+        """
+        Find the slope giving the sharpest elastic line by projecting the
+        filtered images for a range of slopes (coarse, then fine) around 
+        the slope last estimated from the images
+        """
+        self.update_parameters()
+        self.update_background()
+        
+        fnames = [i.data(0) for i in 
+            self._sourcefilesWidget.sourceView.selectedIndexes()]
+        
+        self.tableWidget.table.setRowCount(0)
+        self.spcPlot.clearCurves()
+        self.spcPlot.setGraphTitle('Elastic line FWHM')
+        colors = self.spcPlot.colorList
+        
+        # Photon events are not needed here
+        parameters = self.reduction_parameters()
+        parameters['SPC'] = False
+        
+        opt_slopes = []
+        outofrange = []
+        rixsSpectra = {}
+        for i, fname in enumerate(fnames):
+            f = '/'.join([self._sourcefilesWidget.sourceFolder, fname])
+            rxs = self.get_rixs_spectrum(f, parameters, rixsSpectra)
+            
+            for framenumber in range(len(rxs.spectrum)):
+                slopes, fwhm, best = self.sweep_frame(rxs, framenumber)
+                label = '%.4f' % best
+                if np.isnan(best):
+                    label = 'outside %.4f to %.4f' % (slopes.min(), 
+                        slopes.max())
+                    outofrange.append('%s : %04d' % (fname, framenumber))
+                order = np.argsort(slopes)
+                self.spcPlot.addCurve(slopes[order], fwhm[order], 
+                    'FWHM %s : %04d slope= %.4f' % (fname, framenumber, best), 
+                    color=colors[i%len(colors)], symbol='o', linestyle='-', 
+                    xlabel='Slope', ylabel='FWHM (pixel)', replot=False)
+                
+                nrow = len(opt_slopes)
+                self.tableWidget.table.setRowCount(nrow + 1)
+                self.tableWidget.table.setItem(nrow, 0, 
+                    qt.QTableWidgetItem('%s : %04d' % (fname, framenumber)))
+                self.tableWidget.table.setItem(nrow, 1, 
+                    qt.QTableWidgetItem(label))
+                opt_slopes.append(best)
+        self.spcPlot.replot()
+        if outofrange:
+            print('FWHM minimum at the edge of the slope range for %s, ' 
+                'change the starting slope' % ', '.join(outofrange))
+        
+        self.rixsSpectra = rixsSpectra
+        
+        self.show_mean_slope(opt_slopes)
+        return
+    
+    
+    def sweep_frame(self, rxs, framenumber):
+        """
+        Coarse sweep of sweepCentre +/- sweepRange, moved up to sweepShifts 
+        times while the FWHM minimum is at its edge, then a fine sweep 
+        around the minimum. Returns all slopes, their FWHM and the best 
+        slope, NaN if the minimum is still at the edge.
+        """
+        nslopes = int(round(2 * self.sweepRange / self.sweepStep)) + 1
+        centre = self.sweepCentre
+        slopes, fwhm = [], []
+        for shift in range(self.sweepShifts + 1):
+            coarse_slopes = np.linspace(centre - self.sweepRange, 
+                centre + self.sweepRange, nslopes)
+            x, spectra, coarse_fwhm = rxs.sweep_slopes(coarse_slopes, 
+                framenumber)
+            slopes.append(coarse_slopes)
+            fwhm.append(coarse_fwhm)
+            if np.all(np.isnan(coarse_fwhm)):
+                return np.hstack(slopes), np.hstack(fwhm), np.nan
+            imin = np.nanargmin(coarse_fwhm)
+            if 0 < imin < nslopes - 1:
+                break
+            # Continue on the side of the minimum, overlapping the edge
+            direction = 1 if imin else -1
+            centre += direction * (2 * self.sweepRange - self.sweepStep)
+        else:
+            return np.hstack(slopes), np.hstack(fwhm), np.nan
+        
+        best = coarse_slopes[imin]
+        fine_slopes = np.linspace(best - self.sweepStep, 
+            best + self.sweepStep, 41)
+        x, spectra, fine_fwhm = rxs.sweep_slopes(fine_slopes, framenumber)
+        best = fine_slopes[np.nanargmin(fine_fwhm)]
+        slopes.append(fine_slopes)
+        fwhm.append(fine_fwhm)
+        return np.hstack(slopes), np.hstack(fwhm), best
+    
+    
+    def show_mean_slope(self, opt_slopes):
+        # Mean values, slopes not found are left out
         opt_slopes = np.array(opt_slopes)
         n_slopes = opt_slopes.size
-        if n_slopes < 2: # No reason to calculate mean for only one value
+        opt_slopes = opt_slopes[np.isfinite(opt_slopes)]
+        if opt_slopes.size < 2: # No reason to calculate mean for only one value
             return
         self.tableWidget.table.setRowCount(n_slopes+1)
         self.tableWidget.table.setItem(n_slopes, 0, qt.QTableWidgetItem('MEAN'))
@@ -318,7 +431,7 @@ class MainWindow(qt.QWidget):
             
             
             xfit = np.arange(self.rxs.imageData.shape[1])
-            theta2 = self.RTB_Math.minimize(self.total_huber_loss, [0,0], disp=False)[0]
+            theta2 = self.fit_centroids()[0]
             #~ ts_slope = stats.theilslopes(self.rxs.cp[:,0], self.rxs.cp[:,1], 0.99)
             self.spcPlot.addCurve(self.rxs.cp[0][:,1],self.rxs.cp[0][:,0],'Original data %s' %fname, color=colors[i%len(colors)], symbol='x', linestyle=' ', replot=True)
             self.spcPlot.addCurve(xfit, theta2[0] + theta2[1] * xfit,'Fitted line %s slope= %.4f' %(fname,theta2[1]), color=colors[i%len(colors)], linestyle='-', replot=True)
@@ -342,13 +455,14 @@ class MainWindow(qt.QWidget):
         return
         
         
-    def total_huber_loss(self,theta, c=2): 
+    def fit_centroids(self, c=2):
+        """
+        Line through the photon centroids minimising the Huber loss, see
+        RTB_Math.robust_line_fit. Returns (offset, slope) and the fit info.
+        """
         x=self.rxs.cp[0][:,1]
         y=self.rxs.cp[0][:,0]
-        return self.huber_loss((y - theta[0] - theta[1] * x), c).sum()
-        
-    def huber_loss(self,t, c=2):
-        return ((abs(t) < c) * 0.5 * t ** 2+ (abs(t) >= c) * -c * (0.5 * c - abs(t)))
+        return self.RTB_Math.robust_line_fit(x, y, 'huber', c=c)
 
         
 class Table(qt.QDialog):
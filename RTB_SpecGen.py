@@ -40,6 +40,10 @@ ___doc__ = """
 """
 
 import os
+import time
+import functools
+import multiprocessing
+import concurrent.futures
 
 import numpy as np
 
@@ -51,7 +55,10 @@ from PyMca5.PyMcaGui.pymca import ScanWindow
 from PyMca5.PyMcaGui.pymca import EdfFileSimpleViewer
 
 
-from RixsSpectrum import RixsSpectrum
+from RixsSpectrum import SpecFileWriter, HDF5FileWriter, hdf5_filename, \
+    aggregate_profiles, format_profile, SPEC_DIGITS
+import RTB_Batch
+import RTB_Dark
 from RTB_Icons import RtbIcons
 
 
@@ -98,14 +105,43 @@ class MainWindow(qt.QWidget):
         
         self._exportWidget = ExportWidget(self)
         self._exportWidget.askFileNameCheckBox.hide()
+        self._exportWidget.spcEventsCheckBox.show()
+        self._exportWidget.hdf5CheckBox.show()
         self._convertbuttonWidget = ConvertButtonWidget(self)
         
         self._convertbuttonWidget.setEnabled(False)
         
+        # Live mode: convert new images as they arrive in the folder
+        self.liveCheckBox = qt.QCheckBox('Live')
+        self.liveCheckBox.setToolTip('Convert new images in the image ' 
+            'folder as soon as they are written')
+        self.liveCheckBox.stateChanged.connect(self._liveModeChanged)
+        self.skipConvertedCheckBox = qt.QCheckBox('Skip converted')
+        self.skipConvertedCheckBox.setChecked(True)
+        self.skipConvertedCheckBox.setToolTip('Do not convert again images ' 
+            'already saved to the output file with the same parameters')
+        self.profileCheckBox = qt.QCheckBox('Profile')
+        self.profileCheckBox.setToolTip('Show the time and peak memory of '
+            'each reduction stage\nfor the whole batch and add them to the '
+            '*.spec file')
+        self.profileDialog = None
+        self.liveTimer = qt.QTimer(self)
+        self.liveTimer.setInterval(1000)
+        self.liveTimer.timeout.connect(self._liveTimeout)
+        self.specgenThread = None
+        
         self.statusbar = qt.QStatusBar()
         self.statusLabel = qt.QLabel()
         self.statusLabel.setMinimumWidth(600)
         self.statusbar.addWidget(self.statusLabel)
+        self.progressBar = qt.QProgressBar()
+        self.progressBar.setMaximumWidth(200)
+        self.progressBar.hide()
+        self.statusbar.addPermanentWidget(self.progressBar)
+        self.cancelButton = qt.QPushButton('Cancel')
+        self.cancelButton.hide()
+        self.cancelButton.clicked.connect(self.cancelSpecgen)
+        self.statusbar.addPermanentWidget(self.cancelButton)
         
         
         #~ self._convertbuttonWidget.clicked.connect(self.specgen)
@@ -127,7 +163,12 @@ class MainWindow(qt.QWidget):
         self._inputLayout.addWidget(self.tabWidget, qt.Qt.AlignTop)
         self._inputLayout.addWidget(qt.HorizontalSpacer())
         
-        self._inputLayout.addWidget(self._convertbuttonWidget)
+        self._convertLayout = qt.QVBoxLayout()
+        self._convertLayout.addWidget(self._convertbuttonWidget)
+        self._convertLayout.addWidget(self.liveCheckBox)
+        self._convertLayout.addWidget(self.skipConvertedCheckBox)
+        self._convertLayout.addWidget(self.profileCheckBox)
+        self._inputLayout.addLayout(self._convertLayout)
         self._inputWidget = qt.QWidget()
         #~ self._inputWidget.setContentsMargins(0,0,0,-8)
         self._inputWidget.setLayout(self._inputLayout)
@@ -180,6 +221,8 @@ class MainWindow(qt.QWidget):
         self.SPC_double_threshold = 1.5
         self.ROI = None
         self.ccd_parameters = [0.00016, 1.2, 3.6]
+        # Worker processes for the conversion, one core is left for the GUI
+        self.nprocesses = max(1, (os.cpu_count() or 1) - 1)
         return 0
     
     def connect_signals(self):
@@ -187,8 +230,6 @@ class MainWindow(qt.QWidget):
             self.backgroundWidget.addDarkImages)
         self._sourcefilesWidget.DarkImagesRemoved.connect(
             self.backgroundWidget.removeDarkImages)
-        self.backgroundWidget.DarkImagesViewModelChanged.connect(
-            self.get_dark_images)
     
     def update_parameters(self):
         self.slope = self._parametersWidget._slopeDoubleSpinBox.value()
@@ -205,90 +246,183 @@ class MainWindow(qt.QWidget):
         self._convertbuttonWidget.setEnabled(True)
     
     def launch_specgen_thread(self):
+        # Conversion runs in SpecGenThread, see specgen
         self.specgen()
-        #~ specgenThread = threading.Thread(target=self.specgen)
-        #~ specgenThread.start()
-    
-    
-    def get_dark_images(self):
-        self.darkImages = []
-        for fname in self.backgroundWidget.darkImagesList:
-            x = RixsSpectrum(fname, slope=self.slope, 
-                        points_per_pixel=self.points_per_pixel, 
-                        binning=self.binning,
-                        lower_threshold=self.lower_threshold, 
-                        upper_threshold=self.upper_threshold, 
-                        masksize=self.masksize, 
-                        SPC=False, SPC_gridsize=self.SPC_gridsize, 
-                        SPC_low_threshold=self.SPC_low_threshold, 
-                        SPC_high_threshold=self.SPC_high_threshold, 
-                        SPC_single_threshold=self.SPC_single_threshold, 
-                        SPC_double_threshold=self.SPC_double_threshold, 
-                        roi=self.ROI, ccd_params=self.ccd_parameters,
-                        extract_background=True, background='off'
-                        )
-            for frame in range(len(x.spectrum)):
-                self.darkImages.append((x.info['ExposureTime'][frame], 
-                                        x.rawImageData[:,:,frame]))
     
     
-    def specgen(self):
-        self.update_parameters()
-        #self._update_expertsetting()
-        
-        self.background = None
-        self.backgroundAcquisitionTime = None
+    def update_background(self):
+        # The dark images are only combined in SpecGenThread, so that the 
+        # GUI does not freeze meanwhile
+        self.darkSettings = None
         self.backgroundForceZero = False
         
         if self.backgroundWidget.useDarkImagesCheckBox.isChecked():
-            if self.darkImages:
-                if self.backgroundWidget.methodComboBox.currentIndex() == 0: #Average
-                    self.background = np.dstack(
-                        [img[1] for img in self.darkImages]).mean(axis=2)
-                else: # Sum
-                    self.background = np.dstack(
-                        [img[1] for img in self.darkImages]).sum(axis=2)
-                if self.backgroundWidget.methodComboBox.currentIndex() == 2: #Sum rescaled to acquistion time
-                    self.backgroundAcquisitionTime = sum(
-                        [img[0] for img in self.darkImages])
-                if self.backgroundWidget.zeroBaselineCheckBox.isChecked():
-                    self.backgroundForceZero = True
-        
-        
+            self.darkSettings = self.backgroundWidget.dark_settings(self.ROI)
+            self.backgroundForceZero = \
+                self.backgroundWidget.zeroBaselineCheckBox.isChecked()
+    
+    
+    def specgen(self):
         fnames = [i.data(0) for i in 
             self._sourcefilesWidget.sourceView.selectedIndexes()]
+        if not fnames:
+            return
         
         self._plotSpectraWindow.clearCurves()
         self._plotCountsWindow.clearCurves()
-        counts = []
+        self.counts = []
+        
+        self.convert_images(['/'.join([self._sourcefilesWidget.sourceFolder, 
+            fname]) for fname in fnames])
+    
+    
+    def convert_images(self, images):
+        self.update_parameters()
+        #self._update_expertsetting()
+        self.update_background()
         
         self.outputfilename = self._exportWidget._folderLineEdit.text()
         self.savedatfile = self._exportWidget._datCheckBox.isChecked()
+        self.saveeventfile = self._exportWidget.spcEventsCheckBox.isChecked()
+        self.savehdf5file = self._exportWidget.hdf5CheckBox.isChecked()
+        
+        parameters = dict(slope=self.slope, points_per_pixel=self.points_per_pixel, binning=self.binning,
+            lower_threshold=self.lower_threshold, upper_threshold=self.upper_threshold, 
+            masksize=self.masksize, SPC=self.SPC, SPC_gridsize=self.SPC_gridsize, SPC_low_threshold=self.SPC_low_threshold, SPC_high_threshold=self.SPC_high_threshold, 
+            SPC_single_threshold=self.SPC_single_threshold, SPC_double_threshold=self.SPC_double_threshold, roi=self.ROI, ccd_params=self.ccd_parameters,
+            extract_background=self.backgroundWidget.extractBackgroundCheckBox.isChecked(), 
+            background=None, background_aqn_time=None,
+            background_force_zero=False, 
+            background_smoothing=self.filterBackground, 
+            background_smoothing_width=self.filterWidth)
+        
+        darkBackground = None
+        if self.darkSettings is not None:
+            darkBackground = functools.partial(
+                self.backgroundWidget.dark_background, self.darkSettings)
+        
+        self.specgenThread = SpecGenThread(self, images, self.outputfilename,
+            parameters, savedatfile=self.savedatfile, 
+            saveeventfile=self.saveeventfile, savehdf5file=self.savehdf5file,
+            profile=self.profileCheckBox.isChecked(), 
+            nprocesses=self.nprocesses, darkBackground=darkBackground,
+            forceZero=self.backgroundForceZero,
+            skipConverted=self.skipConvertedCheckBox.isChecked())
+        self.specgenThread.Started.connect(self._specgenStarted)
+        self.specgenThread.ImageConverted.connect(self._imageConverted)
+        self.specgenThread.Progress.connect(self._specgenProgress)
+        self.specgenThread.finished.connect(self._specgenFinished)
         
-        for i, fname in enumerate(fnames):
-            f = '/'.join([self._sourcefilesWidget.sourceFolder, fname])
-            self.statusLabel.setText('Processing %s' % f)
-            x = RixsSpectrum(f, slope=self.slope, points_per_pixel=self.points_per_pixel, binning=self.binning,
-                lower_threshold=self.lower_threshold, upper_threshold=self.upper_threshold, 
-                masksize=self.masksize, SPC=self.SPC, SPC_gridsize=self.SPC_gridsize, SPC_low_threshold=self.SPC_low_threshold, SPC_high_threshold=self.SPC_high_threshold, 
-                SPC_single_threshold=self.SPC_single_threshold, SPC_double_threshold=self.SPC_double_threshold, roi=self.ROI, ccd_params=self.ccd_parameters,
-                extract_background=self.backgroundWidget.extractBackgroundCheckBox.isChecked(), 
-                background=self.background, background_aqn_time=self.backgroundAcquisitionTime,
-                background_force_zero=self.backgroundForceZero, 
-                background_smoothing=self.filterBackground, 
-                background_smoothing_width=self.filterWidth)
-            
-            for framenumber in range(len(x.spectrum)):
-                self._plotSpectraWindow.addCurve(x.spectrum[framenumber]['Pixel'], 
-                    x.spectrum[framenumber]['Photons'], '%s-Photons' % (fname))
-                counts.append(x.spectrum[framenumber]['Photons'].sum())
-                self._plotCountsWindow.addCurve(
-                    np.arange(len(counts)), counts, legend='Counts', symbol='o',
-                    xlabel='', ylabel='Total intensity')
-            
-            x.save(outputfile=self.outputfilename, savedatfile=self.savedatfile)
-            del x
-        self.statusLabel.setText('Done')
+        self._convertbuttonWidget.setEnabled(False)
+        self.progressBar.setRange(0, 0)
+        self.progressBar.show()
+        self.cancelButton.setEnabled(True)
+        self.cancelButton.show()
+        self.statusLabel.setText('Preparing %d images' % len(images))
+        self.specgenThread.start()
+    
+    
+    def _specgenStarted(self, todo, skipped):
+        self.progressBar.setRange(0, max(todo, 1))
+        self.progressBar.setValue(0)
+        self.statusLabel.setText('Processing %d images' % todo + 
+            (' (%d already converted)' % skipped if skipped else ''))
+    
+    
+    def _imageConverted(self, imgfilename, spectra):
+        fname = os.path.basename(imgfilename)
+        for pixel, photons in spectra:
+            self._plotSpectraWindow.addCurve(pixel, photons, 
+                '%s-Photons' % (fname))
+            self.counts.append(photons.sum())
+        self._plotCountsWindow.addCurve(
+            np.arange(len(self.counts)), self.counts, legend='Counts', 
+            symbol='o', xlabel='', ylabel='Total intensity')
+    
+    
+    def _specgenProgress(self, done, total):
+        self.progressBar.setValue(done)
+        self.statusLabel.setText('Processed %d of %d images' % (done, total))
+    
+    
+    def _specgenFinished(self):
+        self.progressBar.hide()
+        self.cancelButton.hide()
+        self._convertbuttonWidget.setEnabled(True)
+        if self.specgenThread.error:
+            self.statusLabel.setText('Error: %s' % self.specgenThread.error)
+        elif not self.specgenThread.images and \
+            not self.liveCheckBox.isChecked():
+            self.statusLabel.setText('All %d images already converted with '
+                'these parameters' % self.specgenThread.skipped)
+        elif self.specgenThread.cancelled:
+            self.statusLabel.setText('Cancelled')
+            self.liveCheckBox.setChecked(False)
+        elif self.liveCheckBox.isChecked():
+            self.statusLabel.setText('Live: waiting for new images in %s' 
+                % self._sourcefilesWidget.sourceFolder)
+        else:
+            self.statusLabel.setText('Done')
+        if self.specgenThread.profile:
+            self.show_profile(self.specgenThread)
+    
+    
+    def show_profile(self, thread):
+        """ Per stage breakdown of the time and memory of a batch """
+        text = 'Profile of %d images, %.2f s in total, stage times summed ' \
+            'over the worker processes:' % (thread.profile['write']['calls'], 
+            thread.walltime)
+        lines = format_profile(thread.profile)
+        print('\n'.join([text] + lines))
+        if self.profileDialog is None:
+            self.profileDialog = qt.QMessageBox(self)
+            self.profileDialog.setWindowTitle('Profile')
+            self.profileDialog.setModal(False)
+        self.profileDialog.setText('%s<pre>%s</pre>' % (text, 
+            '\n'.join(lines)))
+        self.profileDialog.show()
+    
+    
+    def _liveModeChanged(self, state):
+        if self.liveCheckBox.isChecked():
+            folder = self._sourcefilesWidget.sourceFolder
+            outputfile = self._exportWidget._folderLineEdit.text()
+            if not folder or not outputfile:
+                self.statusLabel.setText(
+                    'Live: select the image folder and output file first')
+                self.liveCheckBox.setChecked(False)
+                return
+            # Images already in the folder are not converted
+            self.liveWatcher = RTB_Batch.FolderWatcher(folder)
+            self.livePending = []
+            self._plotSpectraWindow.clearCurves()
+            self._plotCountsWindow.clearCurves()
+            self.counts = []
+            self.liveTimer.start()
+            self.statusLabel.setText('Live: waiting for new images in %s' 
+                % folder)
+        else:
+            self.liveTimer.stop()
+            if not self.specgenThread or not self.specgenThread.isRunning():
+                self.statusLabel.setText('Live mode stopped')
+    
+    
+    def _liveTimeout(self):
+        # Images converted before, e.g. in an earlier live session, are
+        # skipped by convert_images
+        self.livePending += self.liveWatcher.poll()
+        if self.livePending and \
+            not (self.specgenThread and self.specgenThread.isRunning()):
+            images, self.livePending = self.livePending, []
+            self.convert_images(images)
+    
+    
+    def cancelSpecgen(self):
+        if not self.specgenThread or not self.specgenThread.isRunning():
+            return
+        self.cancelButton.setEnabled(False)
+        self.statusLabel.setText('Cancelling, waiting for running images')
+        self.specgenThread.cancel()
         
         
         
@@ -312,6 +446,144 @@ class MainWindow(qt.QWidget):
         self.SPC = self._parametersWidget._spcCheckBox.isChecked()
 
 
+class SpecGenThread(qt.QThread):
+    """
+    Converts images on a pool of worker processes (see RTB_Batch) and 
+    appends the spectra to the output file, and optionally to the HDF5 file
+    next to it, in the order of the images. Each converted image is sent to
+    the GUI with ImageConverted. The background is taken from 
+    darkBackground(), if given, and images already converted are skipped 
+    with skipConverted; both are done in the thread, the number of images
+    left and skipped is sent with Started.
+    """
+    
+    Started = qt.pyqtSignal(int, int)
+    ImageConverted = qt.pyqtSignal(str, object)
+    Progress = qt.pyqtSignal(int, int)
+    
+    def __init__(self, parent, images, outputfile, parameters, 
+        savedatfile=False, saveeventfile=False, savehdf5file=False, 
+        profile=False, nprocesses=None, darkBackground=None, forceZero=False,
+        skipConverted=False):
+        super(SpecGenThread, self).__init__(parent)
+        self.images = images
+        self.outputfile = outputfile
+        self.parameters = dict(parameters)
+        self.darkBackground = darkBackground
+        self.forceZero = forceZero
+        self.skipConverted = skipConverted
+        self.skipped = 0
+        self.outputSettings = RTB_Batch.output_settings(SPEC_DIGITS, True, 
+            savehdf5file, savedatfile, saveeventfile)
+        self.parametersHash = None
+        self.outputs = RTB_Batch.output_files(outputfile, True, savehdf5file)
+        self.savedatfile = savedatfile
+        self.saveeventfile = saveeventfile
+        self.savehdf5file = savehdf5file
+        self.saveprofile = profile
+        # Profile of the converted images, see RixsSpectrum.profile_stage
+        self.profile = None
+        self.walltime = 0.
+        self.nprocesses = nprocesses
+        self.cancelled = False
+        self.error = None
+    
+    
+    def cancel(self):
+        # Images already being converted are finished, but not saved
+        self.cancelled = True
+    
+    
+    def prepare(self):
+        """ Background from the dark images, skip converted images """
+        if self.darkBackground is not None:
+            background, aqn_time = self.darkBackground()
+            self.parameters.update(background=background, 
+                background_aqn_time=aqn_time, 
+                background_force_zero=self.forceZero and 
+                    background is not None)
+        self.parametersHash = RTB_Batch.parameters_hash(self.parameters, 
+            self.outputSettings)
+        if self.skipConverted:
+            manifest = RTB_Batch.ImageManifest(self.outputfile)
+            todo = [imgfilename for imgfilename in self.images 
+                if not manifest.is_converted(imgfilename, 
+                    self.parametersHash)]
+            self.skipped = len(self.images) - len(todo)
+            self.images = todo
+    
+    
+    def run(self):
+        try:
+            self.prepare()
+        except Exception as e:
+            self.error = 'Background: %s' % e
+            return
+        self.Started.emit(len(self.images), self.skipped)
+        if not self.images:
+            return
+        executor, writer, hdf5writer = None, None, None
+        futures = []
+        profiles = []
+        write = {'time': 0., 'calls': 0, 'peak_memory': None}
+        t0 = time.perf_counter()
+        try:
+            # Output files first, a bad path fails before spawning workers
+            manifest = RTB_Batch.ImageManifest(self.outputfile)
+            writer = SpecFileWriter(self.outputfile)
+            if self.savehdf5file:
+                hdf5writer = HDF5FileWriter(hdf5_filename(self.outputfile))
+            # Forking a process running Qt threads is unsafe, always spawn
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(self.nprocesses or len(self.images), 
+                    len(self.images)), 
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=RTB_Batch.init_worker, 
+                initargs=(self.parameters, self.outputfile, self.savedatfile, 
+                    self.saveeventfile, SPEC_DIGITS, 
+                    self.savehdf5file, self.saveprofile))
+            futures = [executor.submit(RTB_Batch.convert_image, imgfilename) 
+                for imgfilename in self.images]
+            for i, (imgfilename, future) in enumerate(
+                zip(self.images, futures)):
+                while not future.done() and not self.cancelled:
+                    concurrent.futures.wait([future], timeout=.2)
+                if self.cancelled:
+                    break
+                try:
+                    scans, spectra, h5scans, profile = future.result()
+                except Exception as e:
+                    self.error = '%s: %s' % (imgfilename, e)
+                    break
+                t = time.perf_counter()
+                writer.write(scans)
+                if hdf5writer is not None:
+                    hdf5writer.write(h5scans)
+                write['time'] += time.perf_counter() - t
+                write['calls'] += 1
+                profiles.append(profile)
+                manifest.add(imgfilename, self.parametersHash, scans, 
+                    self.outputs)
+                self.ImageConverted.emit(imgfilename, spectra)
+                self.Progress.emit(i + 1, len(self.images))
+        except Exception as e:
+            self.error = 'Output: %s' % e
+        finally:
+            for future in futures:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown(wait=True)
+            if writer is not None:
+                writer.close()
+            if hdf5writer is not None:
+                hdf5writer.close()
+            if self.saveprofile and profiles:
+                self.profile = aggregate_profiles(profiles)
+                self.profile['write'] = write
+                self.walltime = time.perf_counter() - t0
+
+
+
 class SourceFilesWidget(qt.QGroupBox):
     
     DarkImagesAdded = qt.pyqtSignal(list)
@@ -552,6 +824,9 @@ class BackgroundWidget(qt.QWidget):
         self.build()
         self.darkImagesList = []
         self.darkImagesViewModel = None
+        self.darkBackgroundKey = None
+        self.darkBackground = (None, None)
+        self.darkLibrary = RTB_Dark.MasterDarkLibrary()
     
     def build(self):
         self.useDarkImagesCheckBox = qt.QCheckBox(''.join([
@@ -570,10 +845,26 @@ class BackgroundWidget(qt.QWidget):
         self.zeroBaselineCheckBox.setToolTip(''.join([
             'Useful for correcting shifts in the detector base mean level\n'
             'due to temperature variations of the CCD chip with time.']))
+        self.sigmaClipCheckBox = qt.QCheckBox(
+            'Reject outliers in dark images beyond (sigma)')
+        self.sigmaClipCheckBox.setToolTip(''.join([
+            'Pixel values further from their mean over all dark frames\n',
+            'are left out, e.g. cosmic rays. Needs many dark frames.']))
+        self.sigmaClipSpinBox = qt.QDoubleSpinBox()
+        self.sigmaClipSpinBox.setRange(1., 10.)
+        self.sigmaClipSpinBox.setSingleStep(.5)
+        self.sigmaClipSpinBox.setValue(3.)
+        
+        sigmaClipLayout = qt.QHBoxLayout()
+        sigmaClipLayout.addWidget(self.sigmaClipCheckBox)
+        sigmaClipLayout.addSpacing(5)
+        sigmaClipLayout.addWidget(self.sigmaClipSpinBox)
+        sigmaClipLayout.addStretch()
             
         methodLayout = qt.QVBoxLayout()
         methodLayout.addWidget(self.methodComboBox)
         methodLayout.addWidget(self.zeroBaselineCheckBox)
+        methodLayout.addLayout(sigmaClipLayout)
         methodLayout.setContentsMargins(20, 5, 20, 10)
         self.methodWidget = qt.QWidget()
         self.methodWidget.setLayout(methodLayout)
@@ -670,6 +961,40 @@ class BackgroundWidget(qt.QWidget):
         return 0
     
     
+    def get_dark_background(self, roi=None):
+        """
+        Background and, for the rescaled sum, acquisition time from the 
+        dark images, see dark_background
+        """
+        return self.dark_background(self.dark_settings(roi))
+    
+    
+    def dark_settings(self, roi=None):
+        """ Dark images, combination method, sigma clip and ROI """
+        method = ['average', 'sum', 'sum-rescaled'][
+            self.methodComboBox.currentIndex()]
+        sigma_clip = None
+        if self.sigmaClipCheckBox.isChecked():
+            sigma_clip = self.sigmaClipSpinBox.value()
+        return (sorted(self.darkImagesList), method, sigma_clip, 
+            list(roi) if roi is not None else None)
+    
+    
+    def dark_background(self, settings):
+        """
+        Background and, for the rescaled sum, acquisition time for the 
+        dark_settings. Kept until the images or settings change and stored
+        in the master dark library for later sessions. The widgets are not
+        accessed, so that it can run outside the GUI thread.
+        """
+        darkfiles, method, sigma_clip, roi = settings
+        if settings != self.darkBackgroundKey:
+            self.darkBackground = self.darkLibrary.get(darkfiles, method, 
+                roi=roi, sigma_clip=sigma_clip)
+            self.darkBackgroundKey = settings
+        return self.darkBackground
+    
+    
     def contextMenuEvent(self, event):
         if self.darkImagesView.selectedIndexes():
             fnames = [i.data(0) for i in self.darkImagesView.selectedIndexes()]
@@ -1152,6 +1477,27 @@ class ExportWidget(qt.QGroupBox):
         self.askFileNameCheckBox.setTristate(False)
         self.askFileNameCheckBox.setEnabled(False)
         
+        self.spcEventsCheckBox = qt.QCheckBox()
+        self.spcEventsCheckBox.setText('Save SPC event lists')
+        self.spcEventsCheckBox.setToolTip(''.join([
+            'Keep the single photon events of each image in a *.npz file\n',
+            'to rebuild the SPC spectra for a new slope or new thresholds\n',
+            'without reading the images again.']))
+        self.spcEventsCheckBox.setCheckState(False)
+        self.spcEventsCheckBox.setTristate(False)
+        self.spcEventsCheckBox.setEnabled(False)
+        self.spcEventsCheckBox.hide()
+        
+        self.hdf5CheckBox = qt.QCheckBox()
+        self.hdf5CheckBox.setText('Also save to HDF5 file')
+        self.hdf5CheckBox.setToolTip(''.join([
+            'Save the spectra with the motors, counters and reduction\n',
+            'parameters into a NeXus (*.h5) file next to the *.spec file.']))
+        self.hdf5CheckBox.setCheckState(False)
+        self.hdf5CheckBox.setTristate(False)
+        self.hdf5CheckBox.setEnabled(False)
+        self.hdf5CheckBox.hide()
+        
         
         self._mainLayout = qt.QGridLayout(self)
         self._mainLayout.setContentsMargins(10, 10, 10, 10)
@@ -1160,6 +1506,8 @@ class ExportWidget(qt.QGroupBox):
         self._mainLayout.addWidget(folderWidget, 0, 0, 1, 2)
         self._mainLayout.addWidget(self._datCheckBox, 1, 0, 1, 1)
         self._mainLayout.addWidget(self.askFileNameCheckBox, 1, 1, 1, 1)
+        self._mainLayout.addWidget(self.spcEventsCheckBox, 2, 0, 1, 2)
+        self._mainLayout.addWidget(self.hdf5CheckBox, 3, 0, 1, 2)
         self.setLayout(self._mainLayout)
         
         
@@ -1225,6 +1573,8 @@ class ExportWidget(qt.QGroupBox):
         self._folderLineEdit.setText(self.outputFile)
         self._datCheckBox.setEnabled(True)
         self.askFileNameCheckBox.setEnabled(True)
+        self.spcEventsCheckBox.setEnabled(True)
+        self.hdf5CheckBox.setEnabled(True)
         
         # ~ self.OutputFileSelected.emit('Output OK')
         self.OutputFileSelected.emit()
@@ -40,12 +40,415 @@ ___doc__ = """
 """
 
 
-import os, time
+import os, time, copy, threading, contextlib, tracemalloc
+from collections import OrderedDict
 import numpy as np
 from PyMca5.PyMcaIO import EdfFile
 from RTB_Math import RTB_Math
 
 import silx.io
+import h5py
+
+
+
+class IsoEnergyProjection(object):
+    """
+    Linear operator integrating a CCD image along iso-energy lines.
+
+    For every point of the spectrum and every column, the old per-column
+    np.interp reads the two rows that bracket the iso-energy line. Along a
+    spectrum point these rows only change every 1/|slope| columns, so the
+    operator is stored as a table of column segments with a constant row
+    pair. Applied to the running sums of each row, one entry per segment
+    is enough to reproduce the summed linear interpolation exactly. The
+    segments are found from the columns where the lines cross the rows and
+    are stored row by row and the running sums are computed for blocks of
+    rows, so that they are read in memory order from the CPU cache.
+    """
+    blockrows = 64
+
+    def __init__(self, nrows, ncols, slope, binning, points_per_pixel):
+        self.nrows = nrows
+        self.ncols = ncols
+        self.step = 1 / points_per_pixel
+        self.x = np.linspace(0, nrows, int(nrows*points_per_pixel))
+        # Shared as the Pixel column of all spectra
+        self.x.flags.writeable = False
+
+        iso = binning * slope * np.arange(ncols)
+        self.maxshift = int(np.ceil(np.abs(iso).max() * points_per_pixel))
+
+        beta = binning * slope
+        # Line of spectrum point k on the row axis: a[k] + beta * column
+        a = self.x + self.step
+        low = a + min(0, beta * (ncols - 1))
+        high = a + max(0, beta * (ncols - 1))
+
+        def first_column(point, m):
+            # First column where the line has passed row m, i.e. is >= m
+            # for a rising and < m for a falling line (ncols if never)
+            if beta > 0:
+                c = np.ceil((m - a[point]) / beta)
+            elif beta < 0:
+                c = np.floor((m - a[point]) / beta) + 1
+            else:
+                c = np.where(a[point] >= m, 0, ncols)
+            return np.clip(c, 0, ncols).astype(np.intp)
+
+        def columns(point, m0, m1):
+            # Columns between the rows m0 and m1 > m0 
+            c0, c1 = first_column(point, m0), first_column(point, m1)
+            return (c0, c1) if beta >= 0 else (c1, c0)
+
+        # Rows crossed by the lines, the points of each row in the order of
+        # their first column
+        row = np.arange(max(nrows - 1, 0))
+        kfirst = np.searchsorted(high, row, 'left')
+        klast = np.searchsorted(low, row + 1, 'left')
+        count = np.maximum(klast - kfirst, 0)
+        row = np.repeat(row, count)
+        offset = np.arange(len(row)) - np.repeat(np.cumsum(count) - count, 
+            count)
+        if beta > 0:
+            point = np.repeat(klast - 1, count) - offset
+        else:
+            point = np.repeat(kfirst, count) + offset
+        c0, c1 = columns(point, row, row + 1)
+        keep = c1 > c0
+        row, point, c0, c1 = row[keep], point[keep], c0[keep], c1[keep]
+        self.outidx = point
+        self.alpha = a[point] - row
+        self.beta = beta
+        # Rows are summed in blocks small enough to stay in the CPU cache,
+        # segment ends relative to their block (one more row for the upper
+        # row of the last one)
+        self.blockstarts = np.arange(0, max(nrows - 1, 0), self.blockrows)
+        self.blockcuts = np.searchsorted(row, np.append(self.blockstarts, 
+            nrows))
+        blockrow = row - row % self.blockrows
+        self.lower = (row - blockrow) * (ncols + 1) + c0
+        self.upper = (row - blockrow) * (ncols + 1) + c1
+
+        # Outside the image np.interp repeats the first or last row
+        point = np.arange(len(a))
+        c0, c1 = columns(point, np.full(len(a), -np.inf), np.zeros(len(a)))
+        f0, f1 = columns(point, np.full(len(a), nrows - 1.), 
+            np.full(len(a), np.inf))
+        first, last = c1 > c0, f1 > f0
+        self.flatidx = np.concatenate([point[first], point[last]])
+        self.flatlower = np.concatenate([c0[first], ncols + 1 + f0[last]])
+        self.flatupper = np.concatenate([c1[first], ncols + 1 + f1[last]])
+        self.column = np.arange(ncols, dtype=float)
+
+
+    def project(self, image):
+        """
+        Integrate a 2D image (rows x columns) along the iso-energy lines
+        """
+        ncols = self.ncols
+        # Running sums of each row of a block, and of the row weighted
+        # by the column number
+        sums = get_scratch_buffer('projection_sums', 
+            (2, self.blockrows + 1, ncols + 1))
+        sums[:,:,0] = 0
+        s0, s1 = sums[0].ravel(), sums[1].ravel()
+        # Same positions on the next row
+        s0next, s1next = s0[ncols+1:], s1[ncols+1:]
+        
+        d = np.empty((4, len(self.outidx)))
+        for i, start in enumerate(self.blockstarts):
+            block = image[start:start+self.blockrows+1]
+            n = len(block)
+            np.cumsum(block, axis=1, dtype=float, out=sums[0,:n,1:])
+            np.multiply(block, self.column, out=sums[1,:n,1:])
+            np.cumsum(sums[1,:n,1:], axis=1, out=sums[1,:n,1:])
+            
+            # Sums over each column segment for the lower and the upper row
+            segments = slice(self.blockcuts[i], self.blockcuts[i+1])
+            lower, upper = self.lower[segments], self.upper[segments]
+            for j, s in enumerate([s0, s0next, s1, s1next]):
+                np.subtract(s.take(upper), s.take(lower), out=d[j,segments])
+        d0, d0next, d1, d1next = d
+        contrib = d0 + self.alpha * (d0next - d0) + self.beta * (d1next - d1)
+        
+        edges = np.cumsum(image[[0, -1]], axis=1, dtype=float)
+        edges = np.hstack([np.zeros((2, 1)), edges]).ravel()
+        flat = edges.take(self.flatupper) - edges.take(self.flatlower)
+        return (np.bincount(self.outidx, contrib, minlength=len(self.x)) + 
+            np.bincount(self.flatidx, flat, minlength=len(self.x))) * \
+            self.step
+
+
+
+_projections = OrderedDict()
+PROJECTION_CACHE_SIZE = 8
+
+# Significant digits of the spectra written to *.spec files
+SPEC_DIGITS = 10
+
+def format_columns(columns, digits=SPEC_DIGITS):
+    """
+    Columns of equal length as text, one line per row with the values
+    separated by spaces. All values are formatted in one call.
+    """
+    data = np.column_stack(columns)
+    line = ' '.join(['%%.%dg' % digits] * data.shape[1]) + '\n'
+    return (line * data.shape[0]) % tuple(data.ravel().tolist())
+
+
+def get_iso_energy_projection(nrows, ncols, slope, binning, points_per_pixel):
+    """
+    Return the (cached) iso-energy projection for the given geometry
+    """
+    key = (nrows, ncols, float(slope), binning, float(points_per_pixel))
+    if key in _projections:
+        _projections[key] = _projections.pop(key)
+    else:
+        _projections[key] = IsoEnergyProjection(*key)
+        while len(_projections) > PROJECTION_CACHE_SIZE:
+            _projections.popitem(last=False)
+    return _projections[key]
+
+
+
+# Frame sized scratch buffers of filter_image, reused for all frames and
+# images processed by a thread
+_scratch = threading.local()
+
+def get_scratch_buffer(name, shape, dtype=float):
+    """
+    Return a reusable buffer of the given shape, its content is undefined
+    """
+    buf = getattr(_scratch, name, None)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype)
+        setattr(_scratch, name, buf)
+    return buf
+
+
+def dilate_mask(mask, radius):
+    """
+    Grow the True pixels of a 2D boolean mask in place to squares of 
+    2*radius+1 pixels, clipped at the image borders. Each axis is done with
+    running sums, so the time does not depend on radius.
+    """
+    if radius < 1:
+        return mask
+    
+    def take(a, axis, start, stop):
+        index = [slice(None), slice(None)]
+        index[axis] = slice(start, stop)
+        return a[tuple(index)]
+    
+    for axis in (0, 1):
+        n = mask.shape[axis]
+        shape = list(mask.shape)
+        shape[axis] += 1
+        counts = get_scratch_buffer('dilate%d' % axis, tuple(shape), np.int32)
+        if axis == 0:
+            # Row by row, numpy's cumsum is slow along the first axis
+            counts[0] = 0
+            for r in range(n):
+                np.add(counts[r], mask[r], out=counts[r+1])
+        else:
+            counts[:,0] = 0
+            np.cumsum(mask, axis=1, dtype=np.int32, out=counts[:,1:])
+        # Pixel r is set if pixels max(r-radius, 0) ... min(r+radius, n-1)
+        # hold a True one, i.e. if the running sum increases in between
+        bounds = sorted(set([0, min(radius+1, n), max(n-radius, 0), n]))
+        for r0, r1 in zip(bounds[:-1], bounds[1:]):
+            if r1 <= n-radius:
+                upper = take(counts, axis, r0+radius+1, r1+radius+1)
+            else:
+                upper = take(counts, axis, n, n+1)
+            if r1 <= radius+1:
+                lower = take(counts, axis, 0, 1)
+            else:
+                lower = take(counts, axis, r0-radius, r1-radius)
+            np.greater(upper, lower, out=take(mask, axis, r0, r1))
+    return mask
+
+
+
+def sweep_iso_energy_slopes(image, slopes, binning=1, points_per_pixel=2, 
+    metric='fwhm', columns_per_block=32):
+    """
+    Project one (filtered) image along the iso-energy lines of many slopes
+    at once. Neighbouring columns are summed in blocks of columns_per_block
+    columns which are shifted as a whole, columns_per_block=1 gives the
+    same result as make_traditional_spectrum.
+    
+    Returns the pixel axis, the spectra (one row per slope, in the same 
+    order as the 'Pixel' column) and the sharpness of each spectrum: the 
+    FWHM of its highest peak (metric='fwhm', smaller is sharper) or the
+    peak height (metric='height', larger is sharper).
+    """
+    slopes = np.atleast_1d(np.asarray(slopes, dtype=float))
+    nrows, ncols = image.shape
+    step = 1 / points_per_pixel
+    x = np.linspace(0, nrows, int(nrows*points_per_pixel))
+    
+    # Sum the columns within each block
+    nblocks = int(np.ceil(ncols / columns_per_block))
+    starts = np.arange(nblocks) * columns_per_block
+    blocks = np.add.reduceat(image, starts, axis=1, dtype=float)
+    centres = 0.5 * (starts + np.minimum(starts + columns_per_block, ncols) - 1)
+    # Difference to the next row, saves one gather per point
+    diffs = np.zeros_like(blocks)
+    diffs[:-1] = blocks[1:] - blocks[:-1]
+    blocks = blocks.ravel()
+    diffs = diffs.ravel()
+    
+    # Linear interpolation on all slopes, spectrum points and blocks. 
+    # Outside the image the first or last row is repeated, like np.interp.
+    spectra = np.zeros((len(slopes), len(x)))
+    chunk = max(1, 2**22 // (len(x) * nblocks))
+    for k in range(0, len(slopes), chunk):
+        shift = binning * slopes[k:k+chunk,None] * centres[None,:]
+        pos = x[None,:,None] + step + shift[:,None,:]
+        row = np.floor(pos)
+        np.clip(row, 0, max(nrows - 2, 0), out=row)
+        pos -= row
+        frac = np.clip(pos, 0, 1, out=pos)
+        index = row.astype(np.intp)
+        index *= nblocks
+        index += np.arange(nblocks)
+        y = diffs[index]
+        y *= frac
+        y += blocks[index]
+        spectra[k:k+chunk] = y.sum(axis=2)
+    spectra *= step
+    spectra = spectra[:,::-1]
+    
+    if metric == 'height':
+        sharpness = spectra.max(axis=1)
+    elif metric == 'fwhm':
+        sharpness = spectrum_fwhm(x, spectra)
+    else:
+        raise ValueError("Unknown sharpness metric '%s'" % metric)
+    return x, spectra, sharpness
+
+
+
+def spectrum_fwhm(x, spectra):
+    """
+    Full width at half maximum of the highest peak in each row of spectra,
+    measured above the median of the spectrum
+    """
+    spectra = np.atleast_2d(spectra)
+    npoints = spectra.shape[1]
+    index = np.arange(npoints)
+    peak = spectra.argmax(axis=1)
+    base = np.median(spectra, axis=1)
+    half = 0.5 * (spectra.max(axis=1) + base)
+    below = spectra < half[:,None]
+    left = np.where(below & (index < peak[:,None]), index, -1).max(axis=1)
+    right = np.where(below & (index > peak[:,None]), index, npoints).min(axis=1)
+    
+    def crossing(i, j):
+        # Half maximum crossing between points i and j of every row
+        i = np.clip(i, 0, npoints - 1)
+        j = np.clip(j, 0, npoints - 1)
+        rows = np.arange(len(spectra))
+        yi, yj = spectra[rows, i], spectra[rows, j]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.where(yj != yi, (half - yi) / (yj - yi), 0)
+        return x[i] + np.clip(t, 0, 1) * (x[j] - x[i])
+    
+    return crossing(right - 1, right) - crossing(left, left + 1)
+
+
+
+class SpectrumFrame(object):
+    """
+    Spectrum columns of one frame. The columns varying along the spectrum
+    are rows of one contiguous 2D array (data), constant columns such as
+    the acquisition time or the counters are kept as scalars and 'Pixel' is
+    the axis shared by all frames. frame[colname] returns a view, constant
+    columns are expanded by broadcasting, i.e. without copy. 
+    """
+    def __init__(self, pixel, columns=()):
+        self.pixel = pixel
+        self.data = np.empty((len(columns), len(pixel)))
+        self.rows = dict((colname, i) for i, colname in enumerate(columns))
+        self.constants = {}
+        self.colnames = ['Pixel']
+    
+    
+    def __setitem__(self, colname, value):
+        if colname == 'Pixel':
+            raise KeyError('Pixel is shared by all frames')
+        if np.ndim(value) == 0:
+            self.constants[colname] = float(value)
+            self.rows.pop(colname, None)
+        else:
+            if colname not in self.rows:
+                # Not reserved in advance
+                self.rows[colname] = len(self.data)
+                self.data = np.vstack([self.data, 
+                    np.empty((1, len(self.pixel)))])
+            self.data[self.rows[colname]] = value
+            self.constants.pop(colname, None)
+        if colname not in self.colnames:
+            self.colnames.append(colname)
+    
+    
+    def __getitem__(self, colname):
+        if colname == 'Pixel':
+            return self.pixel
+        if colname in self.constants:
+            return np.broadcast_to(self.constants[colname], self.pixel.shape)
+        if colname in self.colnames:
+            return self.data[self.rows[colname]]
+        raise KeyError(colname)
+    
+    
+    def __contains__(self, colname):
+        return colname in self.colnames
+    
+    
+    def keys(self):
+        return list(self.colnames)
+    
+    
+    @property
+    def nbytes(self):
+        return self.data.nbytes + 8 * len(self.constants)
+
+
+
+class SpectrumTable(object):
+    """
+    Spectra of all frames of an image, spectrum[framenumber][colname] (see
+    SpectrumFrame). All frames share the 'Pixel' axis.
+    """
+    def __init__(self, pixel, frames=()):
+        self.pixel = pixel
+        self.frames = list(frames)
+    
+    
+    def add_frame(self, columns=()):
+        """ New frame with the rows of the varying columns reserved """
+        frame = SpectrumFrame(self.pixel, columns)
+        self.frames.append(frame)
+        return frame
+    
+    
+    def __len__(self):
+        return len(self.frames)
+    
+    
+    def __getitem__(self, framenumber):
+        return self.frames[framenumber]
+    
+    
+    def __iter__(self):
+        return iter(self.frames)
+    
+    
+    @property
+    def nbytes(self):
+        return self.pixel.nbytes + sum(frame.nbytes for frame in self.frames)
 
 
 
@@ -56,7 +459,8 @@ class RixsSpectrum():
         SPC_single_threshold=.2, SPC_double_threshold=1.5, 
         roi=None, ccd_params=None, extract_background=True, background=None,
         background_aqn_time=None, background_force_zero=False,
-        background_smoothing = False, background_smoothing_width=0):
+        background_smoothing = False, background_smoothing_width=0,
+        stream_frames=False, precision='float64', keep_raw_image=False):
         
         self.RTB_Math = RTB_Math()
         
@@ -77,6 +481,103 @@ class RixsSpectrum():
         
         self.roi = roi
         
+        self.set_ccd_params(ccd_params)
+        
+        self.extract_background     = extract_background
+        self.background             = background
+        self.background_aqn_time    = background_aqn_time
+        self.background_force_zero  = background_force_zero
+        self.background_smoothing   = background_smoothing
+        self.backgroundSmoothingWidth = background_smoothing_width
+        
+        # Process NeXus stacks one frame at a time to save memory
+        self.stream_frames = stream_frames
+        
+        # Floating point type the images are processed in, 'float32' halves
+        # the memory needed. Spectra are always summed in float64, see
+        # check_precision for the accuracy.
+        self.precision = precision
+        
+        # Keep the image read for re-filtering with update(), otherwise it
+        # is filtered in place unless needed for the background extraction
+        self.keep_raw_image = keep_raw_image
+        
+        # Wall time and peak memory of the stages of the last run and of
+        # saving, see profile_stage
+        self.profile = OrderedDict()
+        
+        self._stage_keys = {}
+        self.run()
+        
+        return None
+    
+    
+    # Constructor keywords and the attributes they are stored in
+    parameter_attributes = {
+        'imgfilename': 'imgfilename',
+        'slope': 'slope',
+        'points_per_pixel': 'points_per_pixel',
+        'binning': 'binning',
+        'lower_threshold': 'lower_threshold',
+        'upper_threshold': 'upper_threshold',
+        'masksize': 'masksize',
+        'SPC': 'SPC',
+        'SPC_gridsize': 'SPC_gridsize',
+        'SPC_low_threshold': 'SPC_low_TH',
+        'SPC_high_threshold': 'SPC_high_TH',
+        'SPC_single_threshold': 'SPC_single_TH',
+        'SPC_double_threshold': 'SPC_double_TH',
+        'roi': 'roi',
+        'extract_background': 'extract_background',
+        'background': 'background',
+        'background_aqn_time': 'background_aqn_time',
+        'background_force_zero': 'background_force_zero',
+        'background_smoothing': 'background_smoothing',
+        'background_smoothing_width': 'backgroundSmoothingWidth',
+        'stream_frames': 'stream_frames',
+        'precision': 'precision',
+        'keep_raw_image': 'keep_raw_image',
+        }
+    
+    # Subclasses only needing the header information (e.g. exposure time,
+    # detector size) do not read the pixels
+    read_pixels = True
+    
+    # Reduction stages: name, attributes the stage depends on, stages it
+    # depends on and the method running it
+    stages = [
+        ('load', ['imgfilename', 'roi', 'stream_frames', 'precision'], [], 
+            'get_image'),
+        ('filter', ['lower_threshold', 'upper_threshold', 'masksize', 
+            'binning', 'ccd_params', 'extract_background', 'background', 
+            'background_aqn_time', 'background_force_zero'], ['load'], 
+            'filter_image'),
+        ('project', ['slope', 'points_per_pixel', 'binning', 'SPC',
+            'background_smoothing', 'backgroundSmoothingWidth'], ['filter'], 
+            'make_traditional_spectrum'),
+        ('spc_events', ['SPC_gridsize', 'SPC_low_TH', 'SPC_high_TH'], 
+            ['filter'], 'find_spc_events'),
+        ('spc', ['slope', 'points_per_pixel', 'SPC_single_TH', 
+            'SPC_double_TH'], ['project', 'spc_events'], 
+            'make_single_photon_counting_spectrum'),
+        ]
+    
+    # When streaming frames only the spectra of each frame are kept, so all
+    # processing is done in one stage
+    streaming_stages = [
+        ('load', ['imgfilename', 'roi', 'stream_frames', 'precision'], [], 
+            'get_image'),
+        ('frames', ['lower_threshold', 'upper_threshold', 'masksize', 
+            'binning', 'ccd_params', 'extract_background', 'background', 
+            'background_aqn_time', 'background_force_zero', 'slope', 
+            'points_per_pixel', 'SPC', 'background_smoothing', 
+            'backgroundSmoothingWidth', 'SPC_gridsize', 'SPC_low_TH', 
+            'SPC_high_TH', 'SPC_single_TH', 'SPC_double_TH'], ['load'], 
+            'process_frames'),
+        ]
+    
+    
+    def set_ccd_params(self, ccd_params):
         if ccd_params != None and len(ccd_params)==3:
             self.ccd_params = {
                 'DarkCounts': ccd_params[0],
@@ -89,26 +590,93 @@ class RixsSpectrum():
                 'ElectronsPerCount': 1.2, 
                 'Energy_eh': 3.6 # Electron-hole pair generation energy (eV)
                 }
-        
-        self.extract_background     = extract_background
-        self.background             = background
-        self.background_aqn_time    = background_aqn_time
-        self.background_force_zero  = background_force_zero
-        self.background_smoothing   = background_smoothing
-        self.backgroundSmoothingWidth = background_smoothing_width
-        
-        self.get_image()
-        self.cut_image()
-        self.filter_image()
-        self.make_traditional_spectrum()
-        
-        if self.SPC:
-            self.make_single_photon_counting_spectrum()
-        
-        
+    
+    
+    def update(self, **kwargs):
+        """
+        Change reduction parameters (same keywords as the constructor) and 
+        re-run only the stages depending on them
+        """
+        for name, value in kwargs.items():
+            if name == 'ccd_params':
+                self.set_ccd_params(value)
+            elif name in self.parameter_attributes:
+                setattr(self, self.parameter_attributes[name], value)
+            else:
+                raise TypeError(
+                    "update() got an unexpected keyword argument '%s'" % name)
+        self.run()
+        return None
+    
+    
+    def run(self):
+        """
+        Run the reduction stages. A stage is skipped when the parameters it
+        depends on did not change since its last run and none of the stages
+        it depends on had to be re-run.
+        """
+        rerun = set()
+        self.profile = OrderedDict()
+        if self.stream_frames and self.imgfilename.endswith('.nxs'):
+            stages = self.streaming_stages
+        else:
+            stages = self.stages
+        for stage, attributes, depends, method in stages:
+            if stage.startswith('spc') and not self.SPC:
+                self._stage_keys.pop(stage, None)
+                continue
+            key = [getattr(self, a) for a in attributes]
+            if rerun.intersection(depends) or \
+                not self._same_key(self._stage_keys.get(stage), key):
+                if method == 'process_frames':
+                    # Profiles reading, filtering, ... of each frame itself
+                    getattr(self, method)()
+                else:
+                    with self.profile_stage(stage):
+                        getattr(self, method)()
+                # Keep copies, lists and dicts may be changed in place
+                self._stage_keys[stage] = [k if isinstance(k, np.ndarray) 
+                    else copy.deepcopy(k) for k in key]
+                rerun.add(stage)
         return None
     
     
+    @contextlib.contextmanager
+    def profile_stage(self, stage):
+        """
+        Add the wall time spent inside the with block to profile[stage] and,
+        if tracemalloc is tracing, the peak memory allocated meanwhile
+        """
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self.profile.setdefault(stage, 
+                {'time': 0., 'calls': 0, 'peak_memory': None})
+            entry['time'] += time.perf_counter() - t0
+            entry['calls'] += 1
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1] - start
+                entry['peak_memory'] = max(peak, entry['peak_memory'] or 0)
+    
+    
+    def _same_key(self, old, new):
+        if old is None or len(old) != len(new):
+            return False
+        for o, n in zip(old, new):
+            # Arrays (e.g. dark images) are compared by identity
+            if isinstance(o, np.ndarray) or isinstance(n, np.ndarray):
+                if o is not n:
+                    return False
+            elif o != n:
+                return False
+        return True
+    
+    
     def get_esrf_id32_image(self):
         self.image = EdfFile.EdfFile(self.imgfilename)
         self.motor_mne = self.image.GetHeader(0)['motor_mne'].split()
@@ -128,11 +696,25 @@ class RixsSpectrum():
                 self.image.GetHeader(0)['counter_pos'].split()))
         else:
             self.Counters = None
-        self.imageData = self.image.GetData(0)
-        self.imageData = np.array(self.imageData, dtype=float)
-        if len(self.imageData.shape) < 3:
-            self.imageData.shape += 1,
+        # Only read the pixels inside the ROI
+        nrows = int(self.image.GetStaticHeader(0)['Dim_2'])
+        ncols = int(self.image.GetStaticHeader(0)['Dim_1'])
+        rows, cols = self.get_roi_slices(nrows, ncols)
+        if not self.read_pixels:
+            self.imageData = None
+        elif rows.stop - rows.start < nrows or cols.stop - cols.start < ncols:
+            self.imageData = self.image.GetData(0, Pos=(cols.start, rows.start),
+                Size=(cols.stop - cols.start, rows.stop - rows.start))
+        else:
+            self.imageData = self.image.GetData(0)
+        if self.imageData is not None:
+            self.imageData = np.array(self.imageData, dtype=self.precision)
+            if len(self.imageData.shape) < 3:
+                self.imageData.shape += 1,
         self.info = self.image.GetHeader(0)
+        self.info['NumberOfFrames'] = 1
+        self.info['Dim_1'] = nrows
+        self.info['Dim_2'] = ncols
         self.info['ExposureTime'] =  np.array([float(self.info['count_time'])])
         self.info['ImageNumber'] = self.info['run']
         self.info['ScanNumber'] = self.info['scan_no']
@@ -167,11 +749,15 @@ class RixsSpectrum():
         self.Motors = dict(zip(self.motor_mne, [m for m in self.motor_pos]))
         self.Counters = None
         
-        # Get image data
-        self.imageData = self.image['entry1/andor/data']
-        self.imageData = np.array(self.imageData, dtype=float)
-        self.imageData = np.moveaxis(self.imageData, 0, -1)
-        self.imageData = np.flipud(self.imageData)
+        # Get image data, when streaming the frames are read one by one 
+        # in process_frames
+        dataset = self.image['entry1/andor/data']
+        self.info['Dim_1'], self.info['Dim_2'] = dataset.shape[1:]
+        self.info['NumberOfFrames'] = dataset.shape[0]
+        if self.stream_frames or not self.read_pixels:
+            self.imageData = None
+        else:
+            self.imageData = self.read_dls_i21_frames(0, dataset.shape[0])
         
         # Exposure time
         self.info['ExposureTime'] = self.image['entry1/instrument/andor/count_time'][()]
@@ -182,6 +768,22 @@ class RixsSpectrum():
         self.info['ImageFileName'] = self.imgfilename.split('/')[-1]
         self.info['Experiment'] = self.image['entry1/experiment_identifier'][()]
         self.info['User'] = self.image['entry1/user01/username'][()]
+    
+    
+    def read_dls_i21_frames(self, first, last):
+        """
+        Read frames first...last-1 of an I21 stack as rows x columns x frames.
+        Only the hyperslab inside the ROI is read. The image is flipped 
+        upside down, so are the ROI rows.
+        """
+        dataset = self.image['entry1/andor/data']
+        nrows, ncols = dataset.shape[1:]
+        rows, cols = self.get_roi_slices(nrows, ncols)
+        imageData = dataset[first:last, nrows-rows.stop:nrows-rows.start, 
+            cols.start:cols.stop]
+        imageData = np.array(imageData, dtype=self.precision)
+        imageData = np.moveaxis(imageData, 0, -1)
+        return np.flipud(imageData)
         
         
     
@@ -199,28 +801,40 @@ class RixsSpectrum():
             self.get_dls_i21_image()
             self.info['Beamline'] = 'DLS - I21'
         
-        self.info['Dim_1'] = self.imageData.shape[0]
-        self.info['Dim_2'] = self.imageData.shape[1]
-        self.info['NumberOfFrames'] = self.imageData.shape[2]
+        if self.imageData is not None:
+            self.info['NumberOfFrames'] = self.imageData.shape[2]
         self.info['ImageDate'] = time.strftime('%Y-%m-%d %H:%M:%S', 
             time.localtime(os.stat(self.imgfilename).st_mtime))
+        self.croppedImageData = self.imageData
         return None
     
     
-    def cut_image(self):
+    def get_roi_slices(self, nrows, ncols):
+        """
+        Rows and columns of an image of nrows x ncols pixels inside the ROI
+        [first column, last column, first row, last row]
+        """
+        rows, cols = slice(0, nrows), slice(0, ncols)
         if self.roi != None and len(self.roi) == 4:
             roi_copy = np.array(self.roi)
             for i, r in enumerate(self.roi):
-                if r > self.imageData.shape[1-i//2]:
-                    roi_copy[i] = self.imageData.shape[1-i//2]
-            self.imageData = self.imageData[roi_copy[2]:roi_copy[3], roi_copy[0]:roi_copy[1]]
-        return None
+                if r > (nrows, ncols)[1-i//2]:
+                    roi_copy[i] = (nrows, ncols)[1-i//2]
+            rows = slice(roi_copy[2], roi_copy[3])
+            cols = slice(roi_copy[0], roi_copy[1])
+        # Same meaning of negative or swapped limits as for numpy slicing
+        rows = slice(*rows.indices(nrows)[:2])
+        cols = slice(*cols.indices(ncols)[:2])
+        rows = slice(rows.start, max(rows.start, rows.stop))
+        cols = slice(cols.start, max(cols.start, cols.stop))
+        return rows, cols
     
     
     
     def filter_image(self):
         """
-        Remove the dark counts and spikes from the image
+        Remove the dark counts and spikes from the image. All steps work in
+        place, one frame at a time where temporary arrays are needed.
         """
         if 'energy' not in self.Motors.keys():
             self.Motors['energy'] = 930
@@ -232,18 +846,44 @@ class RixsSpectrum():
         high_cutoff = self.upper_threshold * self.cont_photon * self.binning
         
         
+        # The image read was filtered in place by the last run, read it again
+        if self.croppedImageData is None:
+            self.get_image()
+        
+        # Work on a copy only if the image read is needed later, for the 
+        # background extraction or for re-filtering. The copy made by the 
+        # last run is overwritten.
+        if not (self.extract_background or self.keep_raw_image):
+            self.imageData = self.croppedImageData
+            self.croppedImageData = None
+        elif isinstance(self.imageData, np.ndarray) and \
+            self.imageData.shape == self.croppedImageData.shape and \
+            self.imageData.dtype == self.croppedImageData.dtype and \
+            not np.shares_memory(self.imageData, self.croppedImageData):
+            np.copyto(self.imageData, self.croppedImageData)
+        else:
+            self.imageData = np.array(self.croppedImageData)
+        nframes = self.imageData.shape[2]
+        
         # Background subtraction
         if self.extract_background:
-            self.rawImageData = 1. * self.imageData
+            self.rawImageData = self.croppedImageData
+        else:
+            self.rawImageData = None
         if type(self.background) == type(self.imageData):
             if self.background.shape == self.imageData.shape[:2]:
                 if self.background_aqn_time:
-                    self.imageData -= np.array(self.info['ExposureTime']) \
-                        * np.dstack(self.imageData.shape[2]*[self.background]) \
-                        / self.background_aqn_time
+                    exposure = np.broadcast_to(
+                        np.array(self.info['ExposureTime']), (nframes,))
+                    scaled = get_scratch_buffer('background', 
+                        self.background.shape)
+                    for frame in range(nframes):
+                        np.multiply(exposure[frame], self.background, 
+                            out=scaled)
+                        scaled /= self.background_aqn_time
+                        self.imageData[:,:,frame] -= scaled
                 else:
-                    self.imageData -= \
-                        np.dstack(self.imageData.shape[2]*[self.background])
+                    self.imageData -= self.background[:,:,np.newaxis]
             else:
                 self.imageData -= self.baseline
         
@@ -254,20 +894,18 @@ class RixsSpectrum():
             self.imageData -= self.baseline
             
         
-        # Thresholding
-        self.imageData = np.where(self.imageData < low_cutoff, 
-            0*self.imageData, self.imageData)
-        
-        mask = np.where(self.imageData > high_cutoff, 1, 0)
-        for i in range(1, 1+self.masksize//2):
-            mask[i:,:] += np.roll(mask, 1, axis=0)[i:,:]
-            mask[:-i,:] += np.roll(mask, -1, axis=0)[:-i,:]
-        for i in range(1, 1+self.masksize//2):
-            mask[:,i:] += np.roll(mask, 1, axis=1)[:,i:]
-            mask[:,:-i] += np.roll(mask, -1, axis=1)[:,:-i]
-        # ~ mask += mask.sum(axis=0) # masks the entire line in case of a high-energy event
-        mask = 0 * mask + (mask>0)
-        self.imageData = np.where(mask, 0*self.imageData, self.imageData)
+        # Thresholding, pixels are set to 0*value as before (-0. for negative
+        # values) so that the output does not change
+        mask = get_scratch_buffer('mask', self.imageData.shape[:2], bool)
+        for frame in range(nframes):
+            image = self.imageData[:,:,frame]
+            np.less(image, low_cutoff, out=mask)
+            np.multiply(image, 0, out=image, where=mask)
+            
+            np.greater(image, high_cutoff, out=mask)
+            dilate_mask(mask, self.masksize//2)
+            # ~ mask += mask.sum(axis=0) # masks the entire line in case of a high-energy event
+            np.multiply(image, 0, out=image, where=mask)
         
         return None
     
@@ -289,7 +927,6 @@ class RixsSpectrum():
         Integration along iso-energy lines
         """
         
-        self.spectrum = {}
         self.spectrum_cols = []
         self.spectrum_cols.append('Pixel')
         if self.Counters != None:
@@ -309,55 +946,48 @@ class RixsSpectrum():
         self.spectrum_cols.append('CCD filtered signal (ADC counts)')
         self.spectrum_cols.append('Photons')
         
+        nrows, ncols = self.imageData.shape[:2]
+        projection = get_iso_energy_projection(nrows, ncols,
+            self.slope, self.binning, self.points_per_pixel)
+        self.maxshift = projection.maxshift
+        step = projection.step
+        x_spectrum = projection.x
+        
+        # Counters and acquisition time are constant, stored as scalars
+        constants = ['Storage ring current / 100mA', 'Mirror current / 1e6',
+            'Sample current / 1e6', 'Acquisition time']
+        columns = [colname for colname in self.spectrum_cols[1:] 
+            if colname not in constants]
+        if self.SPC:
+            columns += ['SPC single events', 'SPC double events', 'SPC']
+        self.spectrum = SpectrumTable(x_spectrum)
+
         for framenumber in range(self.info['NumberOfFrames']):
-            imgData = self.imageData[:,:,framenumber]
-            nrows, ncols = imgData.shape
-            iso = self.binning * self.slope * np.arange(ncols)
-            maxshift = np.ceil(np.abs(iso).max() * self.points_per_pixel)
-            self.maxshift = int(maxshift)
-            step = 1 / self.points_per_pixel
-            x0 = np.arange(nrows)
-            x_spectrum = np.linspace(0, nrows, nrows*self.points_per_pixel)
-            y_sum = 0 * x_spectrum
-            
+            y_sum = projection.project(self.imageData[:,:,framenumber])
+
             if self.extract_background:
-                
-                rawImgData = self.rawImageData[:,:,framenumber]
-                yraw_sum = 0 * x_spectrum
-                ythreshold_sum = 0 * x_spectrum
-                if type(self.background) != type(self.imageData) or framenumber == 0:
+                yraw_sum = projection.project(
+                    self.rawImageData[:,:,framenumber])
+                # The projection is linear, no need to project raw-filtered
+                ythreshold_sum = yraw_sum - y_sum
+                if type(self.background) == type(self.imageData):
+                    if framenumber == 0:
+                        background = projection.project(self.background)
+                elif type(self.background) == type(None):
+                    background = 0 * x_spectrum + \
+                        ncols * self.baseline[framenumber] * step
+                else:
                     background = 0 * x_spectrum
-                
-            for iii in range(ncols):
-                x_shifted = x0 - iso[iii] - 1 / self.points_per_pixel
-                y_sum += np.interp(x_spectrum, x_shifted, 
-                    imgData[:,iii]) * step
-                if self.extract_background:
-                    yraw_sum += np.interp(x_spectrum, x_shifted, 
-                        rawImgData[:,iii]) * step
-                    if self.background_smoothing:
-                        ythreshold_sum += np.interp(x_spectrum, x_shifted, 
-                            rawImgData[:,iii]-imgData[:,iii]) * step
-                    if type(self.background) == type(self.imageData):
-                        if framenumber == 0:
-                            background += np.interp(x_spectrum, x_shifted, 
-                                self.background[:,iii]) * step
-                    elif type(self.background) == type(None):
-                        background += 0 * x_spectrum + self.baseline[framenumber] * step
-            
-            
-            
-            
-            self.spectrum[framenumber] = {}
-            self.spectrum[framenumber]['Pixel'] = x_spectrum
+
+            self.spectrum.add_frame(columns)
             if self.Counters != None:
                 self.spectrum[framenumber]['Storage ring current / 100mA'] = \
-                    0*x_spectrum + float(self.Counters['srcur'])/100
+                    float(self.Counters['srcur'])/100
                 self.spectrum[framenumber]['Mirror current / 1e6'] = \
-                    0*x_spectrum + float(self.Counters['mir'])/1e6
+                    float(self.Counters['mir'])/1e6
                 self.spectrum[framenumber]['Sample current / 1e6'] = \
-                    0*x_spectrum + float(self.Counters['sam'])/1e6
-            self.spectrum[framenumber]['Acquisition time'] = 0 * x_spectrum + self.info['ExposureTime'][framenumber]
+                    float(self.Counters['sam'])/1e6
+            self.spectrum[framenumber]['Acquisition time'] = self.info['ExposureTime'][framenumber]
             if self.extract_background:
                 self.spectrum[framenumber]['CCD raw signal (ADC counts)'] = yraw_sum[::-1]
                 self.spectrum[framenumber]['CCD raw background (ADC counts)'] = 0 * x_spectrum + np.flip(background, axis=0)
@@ -394,79 +1024,93 @@ class RixsSpectrum():
         return None
     
     
-    def make_single_photon_counting_spectrum(self):
+    def find_single_photon_events(self, image, low_threshold, high_threshold):
+        """
+        Locate isolated photon events in an image (in units of eV) and 
+        return their centres of mass (row, column) and total intensities
+        """
         gs = self.SPC_gridsize
+        hw = gs // 2
         
-        LOW_TH_PX = self.SPC_low_TH * self.Motors['energy']
-        HIGH_TH_PX = self.SPC_high_TH * self.Motors['energy']
-        SpotLOW = self.SPC_single_TH * self.Motors['energy']
-        SpotHIGH = self.SPC_double_TH * self.Motors['energy']
+        # Find candidates for central pixels
+        inner = image[gs//2:-gs//2, gs//2:-gs//2]
+        candidates = (inner > low_threshold) * (inner < high_threshold)
+        nrows, ncols = inner.shape
         
-        # Rescale image from electron counts to photon energy
+        # Central pixels have no brighter pixel in their gs x gs window.
+        # Separable sliding maximum, fmax ignores NaN like the comparison
+        # with the central pixel does.
+        windowmax = image[:nrows,:]
+        for i in range(1, 2*hw+1):
+            windowmax = np.fmax(windowmax, image[i:nrows+i,:])
+        rowmax = windowmax
+        windowmax = rowmax[:,:ncols]
+        for i in range(1, 2*hw+1):
+            windowmax = np.fmax(windowmax, rowmax[:,i:ncols+i])
+        central_pixel = np.argwhere(candidates * (windowmax <= inner))
         
-        self.spectrum_cols.append('SPC single events')
-        self.spectrum_cols.append('SPC double events')
-        self.spectrum_cols.append('SPC')
+        if len(central_pixel) == 0:
+            return np.zeros((0, 2)), np.zeros(0)
         
-        self.cp = []
+        # Windows around the central pixels, as strided view of the image
+        windows = np.lib.stride_tricks.as_strided(image, 
+            shape=(image.shape[0]-2*hw, image.shape[1]-2*hw, 2*hw+1, 2*hw+1),
+            strides=2*image.strides, writeable=False)
+        spots = windows[central_pixel[:,0], central_pixel[:,1]]
+        spots = np.ascontiguousarray(spots.transpose(1, 2, 0))
+        cp = central_pixel + np.array([gs//2, gs//2], dtype=float)
         
+        # Total intensity in each spot
+        intensities = spots.sum(axis=0, dtype=float).sum(axis=0)
+        
+        # Find center of mass
+        index_rel = np.arange(gs) - gs//2
+        xc = np.dot(spots.sum(axis=0).T, index_rel) / intensities
+        yc = np.dot(spots.sum(axis=1).T, index_rel) / intensities
+        cp += np.vstack([yc, xc]).T
+        return cp, intensities
+    
+    
+    def find_spc_events(self):
+        LOW_TH_PX = self.SPC_low_TH * self.Motors['energy']
+        HIGH_TH_PX = self.SPC_high_TH * self.Motors['energy']
+        
+        self.cp = []
+        self.spc_events = []
+
         for framenumber in range(self.info['NumberOfFrames']):
+            # Rescale image from electron counts to photon energy
             self.SPimage = self.imageData[:,:,framenumber] \
                             * self.ccd_params['ElectronsPerCount'] \
                             * self.ccd_params['Energy_eh']
-            # Find candidates for central pixels
-            central_pixel = np.argwhere(
-                (self.SPimage[gs//2:-gs//2, gs//2:-gs//2] > LOW_TH_PX) * 
-                (self.SPimage[gs//2:-gs//2, gs//2:-gs//2] < HIGH_TH_PX))
-            central_pixel += np.array([gs//2, gs//2])
-            
-            # Identify central pixels
-            cp = []
-            spots = []
-            for i, c in enumerate(central_pixel.tolist()):
-                if np.where(self.SPimage[c[0]-gs//2:c[0]+gs//2+1, \
-                    c[1]-gs//2:c[1]+gs//2+1] > self.SPimage[c[0], 
-                    c[1]], 1, 0).sum() > 0:
-                    pass
-                else:
-                    spots.append(self.SPimage[
-                        c[0]-gs//2:c[0]+gs//2+1, c[1]-gs//2:c[1]+gs//2+1])
-                    cp.append([c[0], c[1]])
-            if len(spots) != 0:
-                spots = np.dstack(spots)
-                cp = np.array(cp, dtype=float)
-            
-                # Total intensity in each spot
-                intensities = spots.sum(axis=0).sum(axis=0)
-            
-                # Find center of mass
-                index_rel = np.arange(gs) - gs//2
-                xc = np.dot(spots.sum(axis=0).T, index_rel) / intensities
-                yc = np.dot(spots.sum(axis=1).T, index_rel) / intensities
-                cp += np.vstack([yc, xc]).T
-            else:
+            cp, intensities = self.find_single_photon_events(
+                self.SPimage, LOW_TH_PX, HIGH_TH_PX)
+            self.spc_events.append((1.*cp, 1.*intensities))
+            if len(cp) == 0:
                 print("No spots!!!")
                 cp = np.array([[0, 0]])
-                intensities = np.array([0])
-    
             self.cp.append(1.*cp)
+        return None
     
-            # Correct the slope
-            cp[:,0] = cp[:,0] - cp[:,1] * self.slope
-            
-            # Separate single and double events
-            cp_single = np.where(
-                (intensities>SpotLOW)*(intensities<=SpotHIGH), cp[:,0], -1)
-            cp_double = np.where(intensities>SpotHIGH, cp[:,0], -1)
-            
-            # Generate spectrum
-            pixel_new = np.linspace(0, self.SPimage.shape[0], 
-                self.SPimage.shape[0]*self.points_per_pixel+1)
-            pixel_new += 0.5 / self.points_per_pixel
-            spectrum_single = np.histogram(cp_single, pixel_new, normed=0)[0][::-1]
-            spectrum_double = np.histogram(cp_double, pixel_new, normed=0)[0][::-1]
-            spectrum = spectrum_single + 2 * spectrum_double
-            
+    
+    def make_single_photon_counting_spectrum(self):
+        SpotLOW = self.SPC_single_TH * self.Motors['energy']
+        SpotHIGH = self.SPC_double_TH * self.Motors['energy']
+        
+        for colname in ['SPC single events', 'SPC double events', 'SPC']:
+            if colname not in self.spectrum_cols:
+                self.spectrum_cols.append(colname)
+        
+        for framenumber, (cp, intensities) in enumerate(self.spc_events):
+            if len(cp) == 0:
+                cp = np.array([[0, 0]])
+                intensities = np.array([0])
+
+            spectrum_single, spectrum_double, spectrum = \
+                histogram_single_photon_events(cp, intensities,
+                    self.imageData.shape[0], self.slope, 
+                    self.points_per_pixel, SpotLOW, SpotHIGH)
+
             # ~ if (self.slope >= 0 and self.info['Beamline'] == 'ESRF - ID32') \
                # ~ or (self.slope >= 0 and self.info['Beamline'] == 'DLS - I21'):
                 # ~ spectrum_single = spectrum_single[self.maxshift:]
@@ -478,16 +1122,195 @@ class RixsSpectrum():
                 # ~ spectrum = spectrum[:-self.maxshift]
             
             # Add spectrum to list of counters
-            self.spectrum[framenumber]['SPC single events'] = 1 * spectrum_single
-            self.spectrum[framenumber]['SPC double events'] = 1 * spectrum_double
-            self.spectrum[framenumber]['SPC'] = 1 * spectrum
+            self.spectrum[framenumber]['SPC single events'] = spectrum_single
+            self.spectrum[framenumber]['SPC double events'] = spectrum_double
+            self.spectrum[framenumber]['SPC'] = spectrum
             
         return None
         
         
     
-    def save(self, outputfile='', savedatfile=False):
-        """ Generate output and write into *.spec and *.dat files """
+    def process_frames(self):
+        """
+        Filter, project and count photons frame by frame, reading each frame
+        from the NeXus file when needed. Only the spectra are kept, 
+        imageData (and rawImageData) hold the last frame only.
+        """
+        exposure_time = self.info['ExposureTime']
+        nframes = self.info['NumberOfFrames']
+        frames, baseline, cp, spc_events = [], [], [], []
+        try:
+            for framenumber in range(nframes):
+                # Make the other methods see a one-frame image
+                self.info['ExposureTime'] = \
+                    exposure_time[framenumber:framenumber+1]
+                self.info['NumberOfFrames'] = 1
+                with self.profile_stage('load'):
+                    self.croppedImageData = self.read_dls_i21_frames(
+                        framenumber, framenumber+1)
+                with self.profile_stage('filter'):
+                    self.filter_image()
+                with self.profile_stage('project'):
+                    self.make_traditional_spectrum()
+                if self.SPC:
+                    with self.profile_stage('spc_events'):
+                        self.find_spc_events()
+                    with self.profile_stage('spc'):
+                        self.make_single_photon_counting_spectrum()
+                    cp += self.cp
+                    spc_events += self.spc_events
+                frames.append(self.spectrum[0])
+                baseline.append(self.baseline)
+        finally:
+            self.info['ExposureTime'] = exposure_time
+            self.info['NumberOfFrames'] = nframes
+        if frames:
+            self.spectrum = SpectrumTable(frames[0].pixel, frames)
+        self.baseline = np.hstack(baseline)
+        if self.SPC:
+            self.cp = cp
+            self.spc_events = spc_events
+        return None
+    
+    
+    def sweep_slopes(self, slopes, framenumber=0, metric='fwhm', 
+        columns_per_block=32):
+        """
+        Project the filtered image of one frame for a whole vector of slopes,
+        see sweep_iso_energy_slopes. The spectra are in photons.
+        """
+        x, spectra, sharpness = sweep_iso_energy_slopes(
+            self.imageData[:,:,framenumber], slopes, self.binning, 
+            self.points_per_pixel, metric, columns_per_block)
+        spectra /= self.cont_photon
+        if metric == 'height':
+            sharpness /= self.cont_photon
+        return x, spectra, sharpness
+    
+    
+    def save_spc_events(self, filename):
+        """
+        Write the SPC event list (row, col, intensity, frame) into a
+        compressed *.npz file, see load_spc_events and rebin_spc_events
+        """
+        frames = [framenumber * np.ones(len(cp), dtype=np.int32)
+            for framenumber, (cp, intensities) in enumerate(self.spc_events)]
+        cp = np.vstack([cp for cp, intensities in self.spc_events])
+        np.savez_compressed(filename,
+            row=cp[:,0], col=cp[:,1],
+            intensity=np.hstack([i for cp, i in self.spc_events]),
+            frame=np.hstack(frames),
+            nframes=self.info['NumberOfFrames'],
+            nrows=self.SPimage.shape[0],
+            energy=float(self.Motors['energy']),
+            image=self.imgfilename)
+        print('SPC events saved to \"%s\"' % (filename))
+        return None
+
+
+    def scan_title(self, framenumber):
+        """ Scan title as in the #S line of the *.spec file """
+        info = self.info
+        if info['Beamline'] == 'ESRF - ID32':
+            return '%s  Scan %04d : %04d - %.1f seconds' % (
+                info['ImageNumber'], int(info['ScanNumber']), 
+                int(info['point_no']), info['ExposureTime'][framenumber])
+        elif info['Beamline'] == 'DLS - I21':
+            return '%s  %s : %04d - %.1f seconds' % (
+                info['ImageNumber'], info['ImageFileName'], 
+                framenumber, info['ExposureTime'][framenumber])
+    
+    
+    def reduction_parameters(self):
+        """ Parameters of the image to spectra conversion """
+        parameters = OrderedDict([
+            ('slope', self.slope),
+            ('points_per_pixel', self.points_per_pixel),
+            ('binning', self.binning),
+            ('lower_threshold', self.lower_threshold),
+            ('upper_threshold', self.upper_threshold),
+            ('masksize', self.masksize),
+            ('SPC', self.SPC),
+            ('SPC_gridsize', self.SPC_gridsize),
+            ('SPC_low_threshold', self.SPC_low_TH),
+            ('SPC_high_threshold', self.SPC_high_TH),
+            ('SPC_single_threshold', self.SPC_single_TH),
+            ('SPC_double_threshold', self.SPC_double_TH),
+            ('roi', self.roi),
+            ('dark_counts', self.ccd_params['DarkCounts']),
+            ('electrons_per_count', self.ccd_params['ElectronsPerCount']),
+            ('energy_eh', self.ccd_params['Energy_eh']),
+            ('extract_background', self.extract_background),
+            ('dark_image', isinstance(self.background, np.ndarray)),
+            ('background_aqn_time', self.background_aqn_time),
+            ('background_force_zero', self.background_force_zero),
+            ('background_smoothing', self.background_smoothing),
+            ('background_smoothing_width', self.backgroundSmoothingWidth),
+            ('precision', self.precision),
+            ])
+        return parameters
+    
+    
+    def make_hdf5_scans(self):
+        """
+        The spectra and their metadata for the HDF5 output, one dictionary
+        per frame (see HDF5FileWriter)
+        """
+        info = self.info
+        motors = OrderedDict()
+        for mne, pos in zip(self.motor_mne, self.motor_pos):
+            try:
+                motors[mne] = float(pos)
+            except (TypeError, ValueError):
+                motors[mne] = pos
+        counters = OrderedDict()
+        if self.Counters != None:
+            for mne, pos in sorted(self.Counters.items()):
+                try:
+                    counters[mne] = float(pos)
+                except (TypeError, ValueError):
+                    counters[mne] = pos
+        
+        scans = []
+        for framenumber in range(info['NumberOfFrames']):
+            image = OrderedDict([
+                ('beamline', info['Beamline']),
+                ('image_name', info['ImageFileName']),
+                ('image_date', info['ImageDate']),
+                ('number_of_frames', info['NumberOfFrames']),
+                ('frame', framenumber),
+                ('exposure_time', 
+                    float(info['ExposureTime'][framenumber])),
+                ('dimensions', [int(info['Dim_1']), int(info['Dim_2'])]),
+                ('scan_number', info['ScanNumber']),
+                ('image_number', info['ImageNumber']),
+                ])
+            for key in ['Experiment', 'User']:
+                if key in info:
+                    image[key.lower()] = info[key]
+            if 'H' in info:
+                image['hkl'] = [float(info[k]) for k in 'HKL']
+            scans.append({
+                'title': self.scan_title(framenumber),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'columns': OrderedDict([(colname, 
+                    self.spectrum[framenumber][colname]) 
+                    for colname in self.spectrum_cols]),
+                'motors': motors,
+                'counters': counters,
+                'parameters': self.reduction_parameters(),
+                'image': image,
+                'comments': list(info['Comments']),
+                })
+        return scans
+    
+    
+    def make_spec_scans(self, digits=SPEC_DIGITS, saveprofile=False):
+        """ 
+        Generate the *.spec output, one scan per frame. The spectra are
+        written with digits significant digits, with saveprofile the 
+        profile of the reduction stages is added as comments.
+        """
         info = self.info
         
         output = []
@@ -507,6 +1330,12 @@ class RixsSpectrum():
         output.append('#C  SPC double event threshold   %.2f\n' % self.SPC_double_TH)
         output.append('#C  \n')
         
+        if saveprofile and self.profile:
+            output.append('#C  Profile of the image to spectra conversion\n')
+            output.append(''.join(['#C  %s\n' % line 
+                for line in format_profile(self.profile)]))
+            output.append('#C  \n')
+        
         if info['Comments']:
             output.append(''.join(['#C  %s\n' % c for c in info['Comments']]))
             output.append('#C  \n')
@@ -544,16 +1373,10 @@ class RixsSpectrum():
         output.append('#N %d\n' % len(self.spectrum_cols))
         output.append('#L  ' + '  '.join(self.spectrum_cols) + '\n')
         
+        scans = []
         for framenumber in range(info['NumberOfFrames']):
             
-            if info['Beamline'] == 'ESRF - ID32':
-                frmoutput = ['#S %s  Scan %04d : %04d - %.1f seconds\n' % (
-                    info['ImageNumber'], int(info['ScanNumber']), 
-                    int(info['point_no']), info['ExposureTime'][framenumber])]
-            elif self.info['Beamline'] == 'DLS - I21':
-                frmoutput = ['#S %s  %s : %04d - %.1f seconds\n' % (
-                    info['ImageNumber'], info['ImageFileName'], 
-                    framenumber, info['ExposureTime'][framenumber])]
+            frmoutput = ['#S %s\n' % self.scan_title(framenumber)]
             
             frmoutput.append('#D %s\n' % time.strftime('%Y-%m-%d %H:%M:%S', 
                 time.localtime(time.time())))
@@ -584,31 +1407,49 @@ class RixsSpectrum():
             
             frmoutput += output
             
-            frmoutput.append(
-                ''.join('%s\n' % (' '.join([str(si) for si in s])) 
-                for s in np.vstack(
-                    [self.spectrum[framenumber][colname] 
-                        for colname in self.spectrum_cols]).T.tolist()))
+            frmoutput.append(format_columns([self.spectrum[framenumber][
+                colname] for colname in self.spectrum_cols], digits))
             
             frmoutput.append('\n')
-            
-            # Save into external data files
-            if outputfile == '':
-                path = header['dir'].replace('/Images', '/Spectra')
-                specfilename = '%s/%s.spec' % (path, header['prefix'])
-            else:
-                specfilename = outputfile
-            if not os.path.isfile(specfilename):
-                with open('%s' % (specfilename), 'wb+') as f:
-                    fileheader = '#F %s\n\n' % (specfilename)
-                    f.write(fileheader.encode('ascii'))
-            with open('%s' % (specfilename), 'ab+') as f:
-                f.write(''.join(frmoutput).encode('ascii'))
-            print('Spectrum saved to \"%s\"' % (specfilename))
-            
+            scans.append(''.join(frmoutput))
+        return scans
+    
+    
+    def save(self, outputfile='', savedatfile=False, saveeventfile=False,
+        savespecfile=True, digits=SPEC_DIGITS, savehdf5file=False, 
+        saveprofile=False):
+        """ 
+        Generate output and write into *.spec, *.h5 and *.dat files. 
+        Returns the scans, savespecfile=False leaves appending them to the 
+        *.spec file to the caller (see SpecFileWriter).
+        """
+        with self.profile_stage('save'):
+            return self._save(outputfile, savedatfile, saveeventfile, 
+                savespecfile, digits, savehdf5file, saveprofile)
+    
+    
+    def _save(self, outputfile, savedatfile, saveeventfile, savespecfile, 
+        digits, savehdf5file, saveprofile):
+        info = self.info
+        
+        # Save into external data files
+        if outputfile == '':
+            path = header['dir'].replace('/Images', '/Spectra')
+            specfilename = '%s/%s.spec' % (path, header['prefix'])
+        else:
+            specfilename = outputfile
+        
+        scans = self.make_spec_scans(digits, saveprofile)
+        if savespecfile:
+            append_spec_scans(specfilename, scans)
+        if savehdf5file:
+            with HDF5FileWriter(hdf5_filename(specfilename)) as writer:
+                writer.write(self.make_hdf5_scans())
+        
+        for framenumber, frmoutput in enumerate(scans):
             if savedatfile:
-                if not os.path.isdir(specfilename.rstrip('.spec')):
-                    os.mkdir(specfilename.rstrip('.spec'))
+                # Parallel workers may create the folder at the same time
+                os.makedirs(specfilename.rstrip('.spec'), exist_ok=True)
                 
                 if info['Beamline'] == 'ESRF - ID32':
                     datfilename = '%s/Scan_%04d_%04d.dat' % (specfilename.rstrip('.spec'),
@@ -617,10 +1458,285 @@ class RixsSpectrum():
                     datfilename = '%s/%s_%04d.dat' % (specfilename.rstrip('.spec'),
                         info['ImageFileName'].rstrip('.nxs'), framenumber)
                 with open(datfilename, 'wb+') as f:
-                    f.write(''.join(frmoutput).encode('ascii'))
+                    f.write(frmoutput.encode('ascii'))
                 print('Spectrum saved to \"%s\"\n' % (datfilename))
-        
+
+        if saveeventfile and self.SPC:
+            eventfolder = os.path.splitext(specfilename)[0]
+            os.makedirs(eventfolder, exist_ok=True)
+            eventfilename = '%s/%s_events.npz' % (eventfolder,
+                os.path.splitext(os.path.basename(self.imgfilename))[0])
+            self.save_spc_events(eventfilename)
+
+        return scans
+
+
+
+def aggregate_profiles(profiles):
+    """
+    Profile of a batch of images from their profiles (see 
+    RixsSpectrum.profile_stage): total time and calls, largest peak memory
+    """
+    total = OrderedDict()
+    for profile in profiles:
+        for stage, entry in profile.items():
+            if stage not in total:
+                total[stage] = {'time': 0., 'calls': 0, 'peak_memory': None}
+            total[stage]['time'] += entry['time']
+            total[stage]['calls'] += entry['calls']
+            if entry['peak_memory'] is not None:
+                total[stage]['peak_memory'] = max(entry['peak_memory'], 
+                    total[stage]['peak_memory'] or 0)
+    return total
+
+
+def format_profile(profile):
+    """ One line per stage: time, share of the total, peak memory, calls """
+    total = sum(entry['time'] for entry in profile.values()) or 1.
+    lines = []
+    for stage, entry in profile.items():
+        if entry['peak_memory'] is None:
+            memory = '%11s' % 'n/a'
+        else:
+            memory = '%8.1f MB' % (entry['peak_memory'] / 2.**20)
+        lines.append('%-12s %9.3f s  %5.1f %%  %s  %6d calls' % (stage, 
+            entry['time'], 100. * entry['time'] / total, memory, 
+            entry['calls']))
+    return lines
+
+
+
+class SpecFileWriter(object):
+    """
+    *.spec file kept open for appending scans (see 
+    RixsSpectrum.make_spec_scans), e.g. for a whole batch of images. Each
+    scan is written at once and the file is flushed after each write.
+    """
+    def __init__(self, specfilename):
+        self.specfilename = specfilename
+        newfile = not os.path.isfile(specfilename)
+        self.file = open(specfilename, 'ab')
+        if newfile:
+            self.file.write(('#F %s\n\n' % (specfilename)).encode('ascii'))
+    
+    
+    def write(self, scans):
+        for scan in scans:
+            self.file.write(scan.encode('ascii'))
+            print('Spectrum saved to \"%s\"' % (self.specfilename))
+        self.file.flush()
+        return None
+    
+    
+    def close(self):
+        self.file.close()
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+def append_spec_scans(specfilename, scans):
+    """
+    Append scans (see RixsSpectrum.make_spec_scans) to a *.spec file
+    """
+    with SpecFileWriter(specfilename) as writer:
+        writer.write(scans)
+    return None
+
+
+def hdf5_filename(specfilename):
+    """ HDF5 file written along with a *.spec file """
+    return '%s.h5' % os.path.splitext(specfilename)[0]
+
+
+class HDF5FileWriter(object):
+    """
+    HDF5 file to append scans to (see RixsSpectrum.make_hdf5_scans), the
+    counterpart of SpecFileWriter. Each scan is a NeXus entry numbered like
+    the scans of a *.spec file read by silx ('1.1', '2.1', ...) with
+    - measurement: the spectrum columns, compressed
+    - spectrum: Photons vs. Pixel for plotting
+    - instrument/positioners and instrument/counters
+    - image: information on the image and frame
+    - reduction: the parameters of the image to spectra conversion
+    """
+    def __init__(self, hdf5filename):
+        self.hdf5filename = hdf5filename
+        self.file = h5py.File(hdf5filename, 'a')
+    
+    
+    def write(self, scans):
+        for scan in scans:
+            n = len(self.file) + 1
+            while '%d.1' % n in self.file:
+                n += 1
+            entry = self.file.create_group('%d.1' % n)
+            entry.attrs['NX_class'] = 'NXentry'
+            entry['title'] = scan['title']
+            entry['start_time'] = scan['date']
+            if scan['comments']:
+                entry['comments'] = '\n'.join(scan['comments'])
+            
+            measurement = entry.create_group('measurement')
+            measurement.attrs['NX_class'] = 'NXcollection'
+            for colname, column in scan['columns'].items():
+                # '/' separates groups in HDF5
+                name = colname.replace(' / ', ' per ').replace('/', '_')
+                dataset = measurement.create_dataset(name, 
+                    data=np.asarray(column, dtype=float), chunks=True, 
+                    compression='gzip', shuffle=True)
+                dataset.attrs['long_name'] = colname
+            
+            if 'Photons' in measurement and 'Pixel' in measurement:
+                plot = entry.create_group('spectrum')
+                plot.attrs['NX_class'] = 'NXdata'
+                plot.attrs['signal'] = 'Photons'
+                plot.attrs['axes'] = 'Pixel'
+                plot['Photons'] = measurement['Photons']
+                plot['Pixel'] = measurement['Pixel']
+                entry.attrs['default'] = 'spectrum'
+            
+            instrument = entry.create_group('instrument')
+            instrument.attrs['NX_class'] = 'NXinstrument'
+            for groupname, values in [('positioners', scan['motors']), 
+                ('counters', scan['counters'])]:
+                group = instrument.create_group(groupname)
+                group.attrs['NX_class'] = 'NXcollection'
+                for name, value in values.items():
+                    group[name.replace('/', '_')] = value
+            
+            for groupname in ['image', 'parameters']:
+                group = entry.create_group(
+                    'reduction' if groupname == 'parameters' else groupname)
+                group.attrs['NX_class'] = 'NXparameters' \
+                    if groupname == 'parameters' else 'NXcollection'
+                for name, value in scan[groupname].items():
+                    if value is not None:
+                        group[name] = value
+            print('Spectrum saved to \"%s\"' % (self.hdf5filename))
+        self.file.flush()
         return None
+    
+    
+    def close(self):
+        self.file.close()
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+
+# Largest deviation of the float32 spectra from the float64 ones, relative 
+# to the largest value of each spectrum column, see check_precision
+FLOAT32_TOLERANCE = 1e-4
+
+def check_precision(imgfilename, tolerance=FLOAT32_TOLERANCE, **parameters):
+    """
+    Reduce an image with precision='float64' and 'float32' and compare the
+    spectra. Returns the largest deviation of each column relative to its
+    largest value. Raises AssertionError if one is above tolerance. 
+    Thresholds and spike masks compare pixel values in float32, a pixel
+    right at a threshold may thus be treated differently, which is the
+    main source of deviations. The SPC columns count events and are only
+    compared when the events found agree.
+    """
+    parameters.pop('precision', None)
+    x64 = RixsSpectrum(imgfilename, precision='float64', **parameters)
+    x32 = RixsSpectrum(imgfilename, precision='float32', **parameters)
+    deviations = {}
+    for framenumber in range(len(x64.spectrum)):
+        for col in x64.spectrum_cols:
+            if col.startswith('SPC') and not np.array_equal(
+                x64.spc_events[framenumber][1] > 0, 
+                x32.spc_events[framenumber][1] > 0):
+                continue
+            y64 = np.asarray(x64.spectrum[framenumber][col], dtype=float)
+            y32 = np.asarray(x32.spectrum[framenumber][col], dtype=float)
+            scale = np.abs(y64).max()
+            deviation = np.abs(y32 - y64).max() / scale if scale else 0.
+            deviations[col] = max(deviation, deviations.get(col, 0.))
+    worst = max(deviations, key=deviations.get)
+    assert deviations[worst] <= tolerance, \
+        'float32 spectra deviate by %.3g in column %s' % (
+            deviations[worst], worst)
+    return deviations
+
+
+def histogram_single_photon_events(cp, intensities, nrows, slope,
+        points_per_pixel, single_threshold, double_threshold):
+    """
+    Generate the SPC spectra (single, double and all events) from the
+    event positions (row, col) and intensities. Thresholds are in eV.
+    """
+    # Correct the slope
+    row = cp[:,0] - cp[:,1] * slope
+
+    # Separate single and double events
+    cp_single = np.where((intensities>single_threshold) *
+        (intensities<=double_threshold), row, -1)
+    cp_double = np.where(intensities>double_threshold, row, -1)
+
+    # Generate spectrum
+    pixel_new = np.linspace(0, nrows, int(nrows*points_per_pixel+1))
+    pixel_new += 0.5 / points_per_pixel
+    spectrum_single = np.histogram(cp_single, pixel_new)[0][::-1]
+    spectrum_double = np.histogram(cp_double, pixel_new)[0][::-1]
+    spectrum = spectrum_single + 2 * spectrum_double
+    return spectrum_single, spectrum_double, spectrum
+
+
+
+def load_spc_events(filename):
+    """
+    Read an SPC event list written by RixsSpectrum.save_spc_events
+    """
+    with np.load(filename) as f:
+        events = dict((key, f[key]) for key in f.files)
+    for key in ['nframes', 'nrows']:
+        events[key] = int(events[key])
+    events['energy'] = float(events['energy'])
+    events['image'] = str(events['image'])
+    return events
+
+
+
+def rebin_spc_events(events, slope, points_per_pixel=2,
+        single_threshold=.2, double_threshold=1.5):
+    """
+    Rebuild the SPC spectra of each frame from an event list (file name or
+    the output of load_spc_events) for a new slope, number of points per
+    pixel or single/double event thresholds (in units of the photon
+    energy, as for RixsSpectrum), without reading the images again.
+    """
+    if not isinstance(events, dict):
+        events = load_spc_events(events)
+    cp = np.vstack([events['row'], events['col']]).T
+    nrows = events['nrows']
+
+    spectra = {}
+    for framenumber in range(events['nframes']):
+        inframe = events['frame'] == framenumber
+        spectrum_single, spectrum_double, spectrum = \
+            histogram_single_photon_events(cp[inframe],
+                events['intensity'][inframe], nrows, slope,
+                points_per_pixel, single_threshold * events['energy'],
+                double_threshold * events['energy'])
+        spectra[framenumber] = {
+            'Pixel': np.linspace(0, nrows, int(nrows*points_per_pixel)),
+            'SPC single events': spectrum_single,
+            'SPC double events': spectrum_double,
+            'SPC': spectrum}
+    return spectra
 
 
 
@@ -45,12 +45,15 @@ def RixsToolBoxVersion():
 
 import sys
 import os
+import multiprocessing
 
 
 from PyMca5.PyMcaGui import PyMcaQt as qt
 # ~ from silx.gui import qt
 
 if __name__ == '__main__':
+    # Needed by the worker processes of the frozen application
+    multiprocessing.freeze_support()
     from RTB_SplashScreen import splash_xpm
     app = qt.QApplication(sys.argv)
     splash_pix = qt.QPixmap(splash_xpm)